@@ -0,0 +1,419 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import matplotlib.pyplot as mat_plot
+import numpy as np
+
+from intelligence import *
+from reporting import *
+from utils import *
+
+SPEEDUP_STATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'Pollution-London Marylebone Road.csv')
+
+REQUIRED_SPEEDUP = 50  # Minimum speed-up of the vectorised reports over the legacy loops on SPEEDUP_STATION
+
+DEFAULTS = {'years': 1, 'stations': 3, 'missing_rate': 0.02, 'sizes': [512, 1024, 2048], 'seed': 0}
+
+
+def time_call(function, *args, repeat=5, **kwargs):
+    '''
+    Returns the best wall time of a function call, in seconds, over a number of runs.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def legacy_daily_average(data, pollutant):
+    '''
+    The loop daily_average was before the vectorised engine (reference of measure_speedups).
+    '''
+    averages = []
+    ind = indices[pollutant]
+    for day_number in range(365):
+        total = 0
+        for hour in range(1, 25):
+            total += float(data[(day_number*24)+hour].split(',')[ind])
+        averages.append(total / 24)
+    return averages
+
+
+def legacy_daily_median(data, pollutant):
+    '''
+    The loop daily_median was before the vectorised engine, with the median of 24 values fixed.
+    '''
+    medians = []
+    ind = indices[pollutant]
+    for day_number in range(365):
+        values = []
+        for hour in range(1, 25):
+            values.append(float(data[day_number*24 + hour].split(',')[ind]))
+        values.sort()
+        medians.append((values[11]+values[12]) / 2)
+    return medians
+
+
+def measure_speedups(path=SPEEDUP_STATION, pollutant='no', repeat=5):
+    '''
+    Speed-up of daily_average and daily_median over their legacy loops, on the first year of a station 
+    file whose missing values are replaced by 0 (the legacy loops stop at the first 'No data').
+
+    @return: dictionary mapping each report to its 'legacy' and 'vectorised' times (seconds) and their 'speedup'
+    '''
+    with open(path) as f:
+        lines = fill_missing_data(f.read().split('\n')[:1 + 24*365], '0', None, pollutant)
+    data = StationData.from_lines(lines)
+    out = {}
+    for name, legacy, report in (('daily_average', legacy_daily_average, daily_average),
+                                 ('daily_median', legacy_daily_median, daily_median)):
+        assert np.allclose(legacy(lines, pollutant), report(data, None, pollutant))
+        slow = time_call(legacy, lines, pollutant, repeat=repeat)
+        fast = min(time_call(report, data, None, pollutant, repeat=20) for _ in range(repeat))
+        out[name] = {'legacy': slow, 'vectorised': fast, 'speedup': slow / fast}
+    return out
+
+
+def check_speedups(report, required=REQUIRED_SPEEDUP):
+    '''
+    @return: list of messages for the reports of a run of the suite below the required speed-up
+    '''
+    return [f"{name}: x{result['speedup']:.0f} over the legacy loop, x{required} required"
+            for name, result in report.get('speedups', {}).items() if result['speedup'] < required]
+
+
+def generate_station_csv(path, years=1, missing_rate=0.02, seed=0, start='2021-01-01'):
+    '''
+    Writes a synthetic station file in the format of the files in data/: a date,time,no,pm10,pm25 header,
+    then one row per hour stamped 01:00:00 to 24:00:00, with 'No data' for missing values.
+
+    @param: path --> output csv file
+    @param: years --> number of years of hourly rows (365 days each)
+    @param: missing_rate --> probability of every value to be 'No data'
+    @param: seed --> seed of the random generator, the same seed always writes the same file
+
+    @return: path
+    '''
+    rng = np.random.default_rng(seed)
+    hours = 24 * 365 * years
+    days = np.datetime_as_string(np.arange(hours) // 24 + np.datetime64(start, 'D'), unit='D')
+    stamps = [f'{hour:02d}:00:00' for hour in range(1, 25)] * (hours // 24)
+    # Diurnal cycle with a morning and an evening peak, plus log-normal noise
+    cycle = 1 + 0.6*np.sin(np.pi * (np.arange(hours) % 24) / 12)**2
+    columns = []
+    for scale, digits in ((20, 5), (18, 1), (10, 1)):
+        values = np.round(scale * cycle * rng.lognormal(0, 0.5, hours), digits).astype(str)
+        values[rng.random(hours) < missing_rate] = MISSING
+        columns.append(values)
+    rows = map(','.join, zip(days, stamps, *columns))
+    with open(path, 'w') as f:
+        f.write('date,time,no,pm10,pm25\n' + '\n'.join(rows))
+    return path
+
+
+def generate_stations(directory, stations=3, years=1, missing_rate=0.02, seed=0):
+    '''
+    Writes synthetic station files (see generate_station_csv) to a directory.
+
+    @return: list of the paths of the files
+    '''
+    os.makedirs(directory, exist_ok=True)
+    return [generate_station_csv(os.path.join(directory, f'station-{i:03d}.csv'), years, missing_rate, seed + i)
+            for i in range(stations)]
+
+
+def generate_map(path, size=1024, seed=0):
+    '''
+    Writes a synthetic square map: a grey and green background crossed by red pavements (as in data/map.png)
+    and cyan water, with the pixel colours of intelligence.COLOURS.
+
+    @param: path --> output png file
+    @param: size --> width and height in pixels
+
+    @return: path
+    '''
+    rng = np.random.default_rng(seed)
+    image = np.empty((size, size, 3), dtype=np.uint8)
+    image[:] = (200, 200, 190)
+    image[rng.random((size, size)) < 0.2] = (120, 170, 90)
+    width = max(2, size // 256)
+    for colour, count in (((230, 20, 20), size // 16), ((20, 200, 220), size // 64)):
+        for _ in range(count):
+            start = rng.integers(0, size - width)
+            span = sorted(rng.integers(0, size, 2))
+            if rng.random() < 0.5:
+                image[start:start + width, span[0]:span[1]] = colour
+            else:
+                image[span[0]:span[1], start:start + width] = colour
+    mat_plot.imsave(path, image)
+    return path
+
+
+def suite_cases(stations, maps):
+    '''
+    Benchmarked entry points of reporting.py, intelligence.py and utils.py.
+
+    @param: stations --> paths of the station files (every reporting case runs on all of them)
+    @param: maps --> paths of the map images (every map is benchmarked)
+
+    @return: list of (name, setup, function): setup() returns the arguments of function
+    '''
+    path = stations[0]
+    loaded = lambda: ([load_station(station, 'SYN') for station in stations],)
+    column = lambda: (load_station(path).column('no'),)
+    listed = lambda: (load_station(path).column('no').tolist(),)
+
+    def each(report):
+        return lambda stations: [report(data) for data in stations]
+
+    def cold_load(paths):
+        for station in paths:
+            shutil.rmtree(cache_directory(station), ignore_errors=True)
+            load_station(station)
+
+    def primed_cache():
+        cache, (stations_data,) = ReportCache(), loaded()
+        for data in stations_data:
+            cache.run(daily_median, data, 'SYN', 'no')
+        return cache, stations_data
+
+    jobs = [(station, pol, report) for station in stations for pol in StationData.pollutants
+            for report in ('daily_median', 'monthly_average', 'week:max,p95')]
+
+    cases = [
+        ('reporting.load_station (cold)', lambda: (stations,), cold_load),
+        ('reporting.load_station (warm)', lambda: (stations,), lambda paths: [load_station(p) for p in paths]),
+        ('reporting.StationData.from_csv', lambda: (stations,), lambda paths: [StationData.from_csv(p) for p in paths]),
+        ('reporting.daily_average', loaded, each(lambda data: daily_average(data, 'SYN', 'no'))),
+        ('reporting.daily_median', loaded, each(lambda data: daily_median(data, 'SYN', 'no'))),
+        ('reporting.hourly_average', loaded, each(lambda data: hourly_average(data, 'SYN', 'no'))),
+        ('reporting.monthly_average', loaded, each(lambda data: monthly_average(data, 'SYN', 'no'))),
+        ('reporting.peak_hour_date', loaded, each(lambda data: peak_hour_date(data, '2021-06-01', 'SYN', 'no'))),
+        ('reporting.peak_hour_range', loaded,
+         each(lambda data: peak_hour_range(data, '2021-01-04', '2021-01-11', 'SYN', 'no'))),
+        ('reporting.top_hours', loaded, each(lambda data: top_hours(data, '2021-01-01', '2022-01-01', 10, 'SYN', 'no'))),
+        ('reporting.value_at', loaded, each(lambda data: value_at(data, '2021-06-01T13', 'SYN', 'no'))),
+        ('reporting.count_missing_data', loaded, each(lambda data: count_missing_data(data, 'SYN', 'pm25'))),
+        ('reporting.missing_runs', loaded, each(lambda data: missing_runs(data, 'pm25'))),
+        ('reporting.fill_column', loaded, each(lambda data: fill_column(data, 'pm25', 'hourly_mean'))),
+        ('reporting.fill_missing_data', loaded, each(lambda data: fill_missing_data(data, 'linear', 'SYN', 'pm25'))),
+        ('reporting.aggregate (percentiles)', loaded,
+         each(lambda data: aggregate(data, 'pm10', 'month', percentiles=(5, 95)))),
+        ('reporting.stream_aggregate', lambda: (stations,),
+         lambda paths: [stream_aggregate(read_station_chunks(p), 'pm10', 'day', percentiles=(95,)) for p in paths]),
+        ('reporting.stream_daily_average', lambda: (stations,),
+         lambda paths: [stream_daily_average(p, 'SYN', 'no') for p in paths]),
+        ('reporting.stream_hourly_average', lambda: (stations,),
+         lambda paths: [stream_hourly_average(p, 'SYN', 'no') for p in paths]),
+        ('reporting.stream_monthly_average', lambda: (stations,),
+         lambda paths: [stream_monthly_average(p, 'SYN', 'no') for p in paths]),
+        ('reporting.ReportCache.run (hits)', primed_cache,
+         lambda cache, stations: [cache.run(daily_median, data, 'SYN', 'no') for data in stations]),
+        ('reporting.run_report_jobs', lambda: (jobs,), run_report_jobs),
+        ('utils.RunningStats', column, RunningStats),
+        ('utils.sumvalues', listed, sumvalues),
+        ('utils.maxvalue', listed, maxvalue),
+        ('utils.minvalue', listed, minvalue),
+        ('utils.meannvalue', listed, meannvalue),
+        ('utils.countvalue', listed, lambda values: countvalue(values, values[0])),
+    ]
+    def raster(image):
+        # .npy copy of the map next to it, for the memory-mapped (out-of-core) paths
+        path = os.path.splitext(image)[0] + '.npy'
+        export_raster(image, path)
+        return path
+
+    for image in maps:
+        size = 'x'.join(map(str, read_image(image).shape[:2]))
+        red = lambda image=image: (colour_mask(read_image(image), 'red'),)
+        components = lambda image=image: detect_connected_components(colour_mask(read_image(image), 'red'), report=None)
+        mapped = lambda image=image: (open_raster(raster(image)),)
+        cases += [
+            (f'intelligence.find_red_pixels {size}', lambda image=image: (image,), find_red_pixels),
+            (f'intelligence.find_cyan_pixels {size}', lambda image=image: (image,), find_cyan_pixels),
+            (f'intelligence.colour_masks {size}', lambda image=image: (image,), colour_masks),
+            (f'intelligence.label_components {size}', red, label_components),
+            (f'intelligence.detect_connected_components {size}', red, detect_connected_components),
+            (f'intelligence.component_stats {size}', components, component_stats),
+            (f'intelligence.top_components {size}', components, lambda labels, sizes: top_components(sizes, 10)),
+            (f'intelligence.detect_connected_components_sorted {size}', components, detect_connected_components_sorted),
+            (f'intelligence.export_raster {size}', lambda image=image: (image, os.path.splitext(image)[0] + '.npy'),
+             export_raster),
+            (f'intelligence.tiled_colour_mask (memmap) {size}', mapped, lambda raster: tiled_colour_mask(raster, tile=512)),
+            (f'intelligence.tiled_label_components {size}', red, lambda mask: tiled_label_components(mask, tile=512)),
+            (f'intelligence.tiled_label_components (memmap) {size}', mapped,
+             lambda raster: tiled_label_components(raster, tile=512)),
+            (f'intelligence.parallel_colour_mask {size}', lambda image=image: (raster(image),),
+             lambda path: parallel_colour_mask(path, tile=512)),
+            (f'intelligence.parallel_label_components {size}', red,
+             lambda mask: parallel_label_components(mask, tile=512)),
+            (f'intelligence.map_pipeline {size}', lambda image=image: (image,), map_pipeline),
+        ]
+    return cases
+
+
+def bounded(low, high):
+    '''
+    argparse type accepting the integers from low to high.
+    '''
+    def parse(text):
+        value = int(text)
+        if not low <= value <= high:
+            raise argparse.ArgumentTypeError(f'{value} is not between {low} and {high}')
+        return value
+    return parse
+
+
+def peak_rss():
+    '''
+    Peak resident set size of the current process, in bytes.
+    '''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def _measure(setup, function, repeat):
+    args = setup()
+    return {'wall': time_call(function, *args, repeat=repeat), 'peak_rss': peak_rss()}
+
+
+def _measure_child(connection, setup, function, repeat):
+    connection.send(_measure(setup, function, repeat))
+    connection.close()
+
+
+def run_case(setup, function, repeat=3):
+    '''
+    Times one case in a forked process, so its peak RSS is not hidden by the cases run before it.
+    Falls back to the current process where fork is not available.
+
+    @return: dictionary with the best 'wall' time in seconds and the 'peak_rss' in bytes
+    '''
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return _measure(setup, function, repeat)
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_measure_child, args=(sender, setup, function, repeat))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError(f'Benchmark process exited with code {process.exitcode}')
+    finally:
+        process.join()
+
+
+def run_suite(directory, years=1, stations=3, missing_rate=0.02, sizes=(512, 1024, 2048), seed=0, repeat=3, only=None):
+    '''
+    Generates the synthetic data in a directory and benchmarks every case of suite_cases on it.
+    The cases run with the directory as working directory, so the files they write end up there.
+
+    @param: directory --> working directory for the synthetic data and the outputs
+    @param: years, stations, missing_rate --> scale of the synthetic station files (see generate_station_csv)
+    @param: sizes --> sizes of the synthetic maps
+    @param: repeat --> number of timed runs of every case (the best one is kept)
+    @param: only --> optional substring, only the cases whose name contains it are run
+
+    @return: dictionary with the 'config' of the run, the 'results' ('wall', 'peak_rss') of every case
+             and the 'speedups' of the reports over their legacy loops (see measure_speedups)
+    '''
+    config = {'years': years, 'stations': stations, 'missing_rate': missing_rate, 'sizes': list(sizes), 'seed': seed}
+    directory = os.path.abspath(directory)
+    paths = generate_stations(os.path.join(directory, 'stations'), stations, years, missing_rate, seed)
+    maps = [generate_map(os.path.join(directory, f'map-{size}.png'), size, seed) for size in sizes]
+
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        for name, setup, function in suite_cases(paths, maps):
+            if only and only not in name:
+                continue
+            results[name] = run_case(setup, function, repeat)
+            print(f"{name}: {results[name]['wall']*1e3:.2f} ms, peak RSS {results[name]['peak_rss']/2**20:.0f} MiB")
+    finally:
+        os.chdir(cwd)
+    report = {'config': config, 'results': results}
+    if not only or only in 'speedups':
+        report['speedups'] = measure_speedups(repeat=repeat)
+        for name, result in report['speedups'].items():
+            print(f"{name}: x{result['speedup']:.0f} over the legacy loop")
+    return report
+
+
+def compare(report, baseline, tolerance=0.25, min_time=0.002):
+    '''
+    Compares a run of the suite to a stored baseline.
+
+    @param: report, baseline --> outputs of run_suite, recorded with the same config
+    @param: tolerance --> relative slowdown (or memory growth) allowed before a case counts as a regression
+    @param: min_time --> absolute slowdown in seconds below which timings are considered noise
+
+    @return: list of messages describing every regression (empty when there is none)
+    '''
+    if report['config'] != baseline['config']:
+        raise ValueError(f"The baseline was recorded with another config: {baseline['config']}")
+    regressions = []
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        if result['wall'] > base['wall'] * (1 + tolerance) and result['wall'] - base['wall'] > min_time:
+            regressions.append(f"{name}: {result['wall']*1e3:.2f} ms against {base['wall']*1e3:.2f} ms")
+        if result['peak_rss'] > base['peak_rss'] * (1 + tolerance):
+            regressions.append(
+                f"{name}: peak RSS {result['peak_rss']/2**20:.0f} MiB against {base['peak_rss']/2**20:.0f} MiB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the reporting, intelligence and utils modules on synthetic data.')
+    parser.add_argument('--years', type=bounded(1, 50), default=DEFAULTS['years'], help='years of hourly data per station (1 to 50)')
+    parser.add_argument('--stations', type=bounded(3, 500), default=DEFAULTS['stations'], help='number of station files (3 to 500)')
+    parser.add_argument('--missing-rate', type=float, default=DEFAULTS['missing_rate'], help="share of 'No data' values")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULTS['sizes'], help='sizes of the synthetic maps')
+    parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case, the best one is kept')
+    parser.add_argument('--only', help='only run the cases whose name contains this')
+    parser.add_argument('--workdir', help='directory for the synthetic data (temporary by default)')
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results to --baseline instead')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='acqua-benchmark-')
+    try:
+        report = run_suite(workdir, args.years, args.stations, args.missing_rate, args.sizes, args.seed,
+                           args.repeat, args.only)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    regressions = check_speedups(report)
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions += compare(report, json.load(f), args.tolerance)
+    for message in regressions:
+        print('REGRESSION', message)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+import atexit
+import cProfile
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+ENVIRONMENT_VARIABLE = 'ACQUA_INSTRUMENT'  # Output file, instrumentation is enabled when it is set
+
+_enabled = False
+_output = None  # File descriptor of the JSON lines output
+_profiler = None
+_profile_path = None
+_totals = {}  # Function name --> aggregated counters of all its calls
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _Call:
+    '''
+    Counters of one running call of an instrumented function.
+    '''
+    __slots__ = ('name', 'start', 'wall', 'bytes_read', 'rows')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.wall = 0.0
+        self.bytes_read = 0
+        self.rows = 0
+
+
+def is_enabled():
+    '''
+    True when calls of the instrumented functions are being recorded.
+    '''
+    return _enabled
+
+
+def enable(path=None):
+    '''
+    Starts recording the calls of the instrumented functions.
+
+    @param: path --> output file: a '.prof' or '.pstats' path receives a cProfile dump of the whole run,
+                     any other path one JSON line per call (and a summary line per function on disable()).
+                     None only aggregates the counters in memory (see summary)
+    '''
+    global _enabled, _output, _profiler, _profile_path
+    disable()
+    _totals.clear()
+    if path and path.endswith(('.prof', '.pstats')):
+        _profile_path = path
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif path:
+        _output = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_TRUNC, 0o644)
+    _enabled = True
+
+
+def disable():
+    '''
+    Stops recording, writes the summary line of every function (or the cProfile dump) and closes the output.
+    '''
+    global _enabled, _output, _profiler
+    if not _enabled:
+        return
+    _enabled = False
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        _profiler = None
+    if _output is not None:
+        for name, totals in summary().items():
+            _write({'summary': name, **totals})
+        os.close(_output)
+        _output = None
+
+
+def summary():
+    '''
+    Counters aggregated over all the recorded calls.
+
+    @return: dictionary mapping the name of each function (module.function) to its 'calls',
+             total 'wall' time in seconds, 'bytes_read' and 'rows' processed
+    '''
+    with _lock:
+        return {name: dict(totals) for name, totals in _totals.items()}
+
+
+def record(bytes_read=0, rows=0):
+    '''
+    Adds bytes read or rows processed to the innermost instrumented call running in this thread.
+    Does nothing when instrumentation is disabled.
+    '''
+    if _enabled:
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            stack[-1].bytes_read += bytes_read
+            stack[-1].rows += rows
+
+
+def worker_call(function, *args):
+    '''
+    Runs a function in a worker process and returns its result along with the counters of the instrumented 
+    calls it made, which the parent process adds to its own with merge_counters. Worker processes exit 
+    without writing summary lines, so this is how their calls reach the summary.
+
+    @param: function, args --> function run by the worker and its arguments
+
+    @return: result, counters (None when instrumentation is disabled)
+    '''
+    if not _enabled:
+        return function(*args), None
+    with _lock:
+        _totals.clear()  # Totals inherited from the parent, or left by the previous task of this worker
+    stack, call = _push(None)  # Collects the bytes and rows of the outermost calls
+    try:
+        result = function(*args)
+    finally:
+        stack.pop()
+    return result, {'totals': summary(), 'bytes_read': call.bytes_read, 'rows': call.rows}
+
+
+def merge_counters(counters):
+    '''
+    Adds the counters returned by worker_call to the totals of this process, and the bytes read and rows 
+    processed by the worker to the innermost instrumented call running in this thread (see record).
+    '''
+    if not counters or not _enabled:
+        return
+    for name, totals in counters['totals'].items():
+        _accumulate(name, **totals)
+    record(counters['bytes_read'], counters['rows'])
+
+
+def _accumulate(name, calls, wall, bytes_read, rows):
+    with _lock:
+        totals = _totals.setdefault(name, {'calls': 0, 'wall': 0.0, 'bytes_read': 0, 'rows': 0})
+        totals['calls'] += calls
+        totals['wall'] += wall
+        totals['bytes_read'] += bytes_read
+        totals['rows'] += rows
+
+
+def _write(entry):
+    if _output is not None:
+        # A single write per line on an O_APPEND file, so that threads and forked workers do not interleave
+        os.write(_output, (json.dumps(entry) + '\n').encode())
+
+
+def _push(name):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    call = _Call(name)
+    stack.append(call)
+    return stack, call
+
+
+def _pop(stack, call):
+    stack.pop()
+    if stack:
+        # Counters are inclusive: the caller also gets the bytes and rows of its callees
+        stack[-1].bytes_read += call.bytes_read
+        stack[-1].rows += call.rows
+    _accumulate(call.name, 1, call.wall, call.bytes_read, call.rows)
+    _write({'function': call.name, 'start': call.start, 'wall': call.wall, 'bytes_read': call.bytes_read,
+            'rows': call.rows, 'depth': len(stack), 'pid': os.getpid(), 'thread': threading.get_ident()})
+
+
+def instrumented(function, name=None):
+    '''
+    Decorator recording the wall time, bytes read and rows processed of every call of a function.
+    When instrumentation is disabled the wrapper only checks a flag before calling the function.
+    The time of a generator is the time spent producing its items, recorded when it is exhausted or closed.
+
+    @param: function --> function to instrument
+    @param: name --> name of its records, module.qualified_name by default
+    '''
+    name = name or f'{function.__module__}.{function.__qualname__}'
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return (yield from function(*args, **kwargs))
+            generator = function(*args, **kwargs)
+            call = _Call(name)
+            value = None
+            try:
+                while True:
+                    stack = getattr(_local, 'stack', None)
+                    if stack is None:
+                        stack = _local.stack = []
+                    stack.append(call)
+                    start = time.perf_counter()
+                    try:
+                        item = generator.send(value)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        call.wall += time.perf_counter() - start
+                        stack.pop()
+                    value = yield item
+            finally:
+                generator.close()
+                stack = getattr(_local, 'stack', [])
+                stack.append(call)
+                _pop(stack, call)
+        return wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        stack, call = _push(name)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            call.wall = time.perf_counter() - start
+            _pop(stack, call)
+    return wrapper
+
+
+def instrument_module(module_name, exclude=()):
+    '''
+    Instruments every public function of a module, and the public methods of its classes, in place.
+    Called at the end of a module so that calls made within the module also go through the wrappers.
+
+    @param: module_name --> __name__ of the module
+    @param: exclude --> names ('function' or 'Class.method') left as they are, eg: per-element hot paths
+    '''
+    module = sys.modules[module_name]
+    for attr, value in list(vars(module).items()):
+        if attr.startswith('_') or attr in exclude or getattr(value, '__module__', None) != module_name:
+            continue
+        if inspect.isfunction(value):
+            setattr(module, attr, instrumented(value))
+        elif inspect.isclass(value):
+            for method_name, method in list(vars(value).items()):
+                if method_name.startswith('_') or f'{attr}.{method_name}' in exclude:
+                    continue
+                if isinstance(method, (classmethod, staticmethod)):
+                    setattr(value, method_name, type(method)(instrumented(method.__func__)))
+                elif inspect.isfunction(method):
+                    setattr(value, method_name, instrumented(method))
+
+
+def _after_fork():
+    # Forked workers keep recording their calls to the shared output, but only the parent profiles
+    global _profiler
+    _profiler = None
+    _local.__dict__.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(disable)
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    enable(os.environ[ENVIRONMENT_VARIABLE])
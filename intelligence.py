@@ -1,26 +1,113 @@
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 from matplotlib import pyplot as mat_plot
 import numpy as np
 
+from instrumentation import instrument_module, merge_counters, record, worker_call
+
+
+COLOURS = {'red': ((101, 255), (0, 49), (0, 49)),
+           'cyan': ((0, 49), (101, 255), (101, 255))}
+# Inclusive (min, max) range of the R, G and B channels (0 to 255) for each colour class.
+# Red is R > 100, G < 50, B < 50 and cyan is R < 50, G > 100, B > 100.
+
+
+def read_image(path):
+    '''
+    Reads an image as a uint8 RGB(A) array with channels from 0 to 255.
+
+    @param: path --> path to the image file, or an image array (returned as uint8 without reading anything)
+
+    @return: uint8 array of shape (height, width, channels)
+    '''
+    if isinstance(path, str):
+        record(bytes_read=os.path.getsize(path))
+        arr = mat_plot.imread(path)
+    else:
+        arr = np.asarray(path)
+    if arr.dtype == np.uint8:
+        return arr
+    # PNGs are read as floats between 0 and 1, truncated to integers the same way as astype('i')
+    return (arr * 255).astype(np.uint8)
+
+
+def colour_mask(image, ranges):
+    '''
+    Boolean mask of the pixels whose R, G and B channels all fall within the given ranges.
+    The thresholds are evaluated as one NumPy expression over the whole image.
+
+    @param: image --> uint8 image array (see read_image)
+    @param: ranges --> name of a colour in COLOURS, or ((rmin, rmax), (gmin, gmax), (bmin, bmax)), bounds included
+
+    @return: boolean array of shape (height, width)
+    '''
+    if isinstance(ranges, str):
+        ranges = COLOURS[ranges]
+    mask = np.ones(image.shape[:2], dtype=bool)
+    for channel, (low, high) in enumerate(ranges):
+        values = image[..., channel]
+        mask &= (values >= low) & (values <= high)
+    return mask
+
+
+def colour_masks(path, colours=tuple(COLOURS)):
+    '''
+    Computes the masks of several colour classes, reading the image only once.
+
+    @param: path --> path to the image file, or an image array
+    @param: colours --> names of colours in COLOURS, or a dictionary mapping names to channel ranges
+
+    @return: dictionary mapping each colour to its boolean mask
+    '''
+    image = read_image(path)
+    if not isinstance(colours, dict):
+        colours = {name: COLOURS[name] for name in colours}
+    return {name: colour_mask(image, ranges) for name, ranges in colours.items()}
+
+
+def pack_mask(mask):
+    '''
+    Packs a boolean mask into bits (8 pixels per byte along each row).
+    '''
+    return np.packbits(mask, axis=-1)
+
+
+def unpack_mask(packed, shape):
+    '''
+    Inverse of pack_mask.
+
+    @param: packed --> array returned by pack_mask
+    @param: shape --> (height, width) of the original mask
+    '''
+    return np.unpackbits(packed, axis=-1, count=shape[1]).astype(bool)
+
+
+def mask_to_image(mask):
+    '''
+    Converts a mask into a black and white uint8 RGBA image (white where the mask is set).
+    '''
+    out = np.zeros(mask.shape + (4,), dtype=np.uint8)
+    out[mask, :3] = 255
+    out[..., 3] = 255
+    return out
+
 
 def find_red_pixels(path, *args, **kwargs):
     '''
     Reads a city map and outputs a binary image of all its RED pixels saved as map-red-pixels.jpg
 
-    @param: path --> Relative path to the image file of the map
+    @param: path --> Relative path to the image file of the map (or the image array)
+    @param: output --> optional keyword, file the image is saved to (None to skip it)
 
     @return: binary array (black and white) with all the red pixels of the image. 
     '''
-    arr = mat_plot.imread(path)
-    out = ((arr.copy())*255).astype('i')
-
-    for row in range(len(out)):
-        for col in range(len(out[0])):
-            if out[row][col][0] > 100 and out[row][col][1] < 50 and out[row][col][2] < 50:
-                out[row][col] = 255, 255, 255, 255
-            else:
-                out[row][col] = 0, 0, 0, 255
-    out = out.astype('uint8')
-    mat_plot.imsave('map-red-pixels.jpg', out)
+    out = mask_to_image(colour_mask(read_image(path), 'red'))
+    output = kwargs.get('output', 'map-red-pixels.jpg')
+    if output:
+        mat_plot.imsave(output, out)
     return out
 
 
@@ -28,120 +115,546 @@ def find_cyan_pixels(path, *args, **kwargs):
     '''
     Reads a city map and outputs a binary image of all its CYAN pixels saved as map-cyan-pixels.jpg
 
-    @param: path --> Relative path to the image file of the map
+    @param: path --> Relative path to the image file of the map (or the image array)
+    @param: output --> optional keyword, file the image is saved to (None to skip it)
 
     @return: binary array (black and white) with all the cyan pixels of the image. 
     '''
-    arr = mat_plot.imread(path)
-    out = ((arr.copy())*255).astype('i')
-    for row in range(len(out)):
-        for col in range(len(out[0])):
-            if out[row][col][0] < 50 and out[row][col][2] > 100 and out[row][col][1] > 100:
-                out[row][col] = 255, 255, 255, 255
-            else:
-                out[row][col] = 0, 0, 0, 255
-    out = out.astype('uint8')
-    mat_plot.imsave('map-cyan-pixels.jpg', out)
+    out = mask_to_image(colour_mask(read_image(path), 'cyan'))
+    output = kwargs.get('output', 'map-cyan-pixels.jpg')
+    if output:
+        mat_plot.imsave(output, out)
     return out
 
 
+def merge_roots(n, a, b):
+    '''
+    Vectorised union-find: merges the elements linked by each pair (a[i], b[i]).
+    Roots are hooked onto the smaller root of every pair and paths are compressed by pointer jumping,
+    until no pair links two different roots.
+
+    @param: n --> number of elements
+    @param: a, b --> integer arrays of linked element pairs
+
+    @return: root of every element, which is the smallest element of its set
+    '''
+    parent = np.arange(n)
+    a, b = np.asarray(a, dtype=np.intp), np.asarray(b, dtype=np.intp)
+    while True:
+        root_a, root_b = parent[a], parent[b]
+        linked = root_a != root_b
+        if not linked.any():
+            return parent
+        low = np.minimum(root_a[linked], root_b[linked])
+        high = np.maximum(root_a[linked], root_b[linked])
+        np.minimum.at(parent, high, low)
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+
+
+def _mask_runs(mask):
+    '''
+    Horizontal runs of set pixels, in raster order.
+
+    @return: rows, starts, ends (exclusive) of every run
+    '''
+    edges = np.diff(np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    return rows, starts, ends
+
+
+def label_components(mask, connectivity=8):
+    '''
+    Connected component labelling in linear time.
+    Set pixels are grouped into horizontal runs, runs of neighbouring rows that touch are found with 
+    a binary search, and the runs are merged with a vectorised union-find (see merge_roots).
+
+    @param: mask --> 2D boolean array
+    @param: connectivity --> 8 (diagonal neighbours are connected) or 4
+
+    @return: labels --> int32 array of the mask's shape, 0 for the background and 1 to n for the components,
+                        numbered in the order in which a raster scan first meets them
+    @return: sizes --> number of pixels of each component, indexed by label (sizes[0] is 0)
+    '''
+    if connectivity not in (4, 8):
+        raise ValueError('Connectivity must be 4 or 8')
+    mask = np.asarray(mask, dtype=bool)
+    reach = 1 if connectivity == 8 else 0
+    rows, starts, ends = _mask_runs(mask)
+
+    # Runs are sorted by (row, start) and by (row, end), so the runs of the previous row touching a run
+    # form a contiguous range found by binary search over those keys.
+    stride = mask.shape[1] + 4
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    first = np.searchsorted(end_keys, (rows - 1) * stride + starts - reach, side='right')
+    last = np.searchsorted(start_keys, (rows - 1) * stride + ends + reach, side='left')
+    touching = np.maximum(last - first, 0)
+    run = np.repeat(np.arange(len(rows)), touching)
+    above = np.repeat(first, touching) + np.arange(touching.sum()) - np.repeat(np.cumsum(touching) - touching, touching)
+
+    roots = merge_roots(len(rows), run, above)
+    _, run_labels = np.unique(roots, return_inverse=True)
+    run_labels = run_labels.astype(np.int32) + 1
+
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    labels[mask] = np.repeat(run_labels, ends - starts)
+    sizes = np.bincount(run_labels, weights=ends - starts, minlength=1).astype(np.int64)
+    sizes[0] = 0
+    return labels, sizes
+
+
+def write_component_report(sizes, path, regions=None):
+    '''
+    Writes the number of pixels of each connected component to a .txt file.
+
+    @param: sizes --> pixels per component, indexed by label
+    @param: path --> output file
+    @param: regions --> labels in the order to write them (all components by label order by default)
+    '''
+    regions = range(1, len(sizes)) if regions is None else regions
+    with open(path, 'w+') as f:
+        for region in regions:
+            f.write(f'Connected component {region}, number of pixels = {sizes[region]}\n')
+        f.write(f'Total number of connected components = {len(sizes) - 1}')
+
+
+def binary_mask(image):
+    '''
+    Mask of the white pixels of a black and white image (as written by find_red_pixels).
+
+    @param: image --> path to the image, image array, or a 2D boolean mask which is returned as it is
+    '''
+    if not isinstance(image, str) and np.ndim(image) == 2:
+        return np.asarray(image, dtype=bool)
+    arr = read_image(image).astype(np.int16)
+    # R + G above 255 keeps the white pixels despite the artefacts of a JPEG file
+    return arr[..., 0] + arr[..., 1] > 255
+
+
+def save_mask(mask, path):
+    '''
+    Writes a mask to disk: as a black and white image (eg: .png, lossless), or bit-packed in a .npz file.
+    '''
+    if path.endswith('.npz'):
+        np.savez(path, bits=pack_mask(mask), shape=np.array(mask.shape))
+    else:
+        mat_plot.imsave(path, mask_to_image(mask))
+
+
+def load_mask(path):
+    '''
+    Reads a mask written by save_mask.
+    '''
+    if path.endswith('.npz'):
+        with np.load(path) as saved:
+            return unpack_mask(saved['bits'], tuple(saved['shape']))
+    return binary_mask(path)
+
+
 def detect_connected_components(image='map-red-pixels.jpg', *args, **kwargs):
     '''
     Connected component detection algorithm.
-    This implementation uses an empty placeholder matrix to which is written white pixels when a pavement is detected in the original image. It is optimised to be composed of boolean values only. 
-    It uses counters to keep track of regions of connected components and the number of pixels they have. 
-
-    @param: image --> path to the red pixel binary map.
-
-    @return: mark --> array with all pavements marked as visited
-    @return: data_for_sort --> used as input in the sorted function. Composed of a dictionary with each region of connected components mapped to the number of pixels it contains. Also, there is a list of coords for all pixels belonging to that region. 
-    '''
-    arr = mat_plot.imread(image) / 255
-    Q = np.array([[0, 0]])
-    components = []
-    height = len(arr)
-    width = len(arr[0])
-    mark = [[False for _ in range(width)] for _ in range(height)]
-
-    f = open('cc-output-2a.txt', 'w+')
-    region = 0
-    data_for_sort = [{}, []]
-
-    for row in range(height):
-        for col in range(width):
-            if sum(arr[row][col][:2]) > 1 and not mark[row][col]:
-
-                Q = np.concatenate([Q, np.array([[row, col]])])
-                component = []
-                region += 1
-                region_size = 0
-                data_for_sort[1].append([])
-                while Q.size != 0:
-
-                    m, n = Q[0]
-                    Q = np.delete(Q, 0, axis=0)
-                    component.append((m, n))
-
-                    neighbours = [(m-1, n-1), (m-1, n), (m-1, n+1),
-                                  (m, n-1), (m, n+1),
-                                  (m+1, n-1), (m+1, n), (m+1, n+1)]
-                    for s, t in neighbours:
-                        if s < height and t < width:
-                            if sum(arr[s][t][:2]) > 1 and not mark[s][t]:
-                                mark[s][t] = True
-                                Q = np.concatenate([Q, np.array([[s, t]])])
-                                data_for_sort[1][region-1].append((s, t))
-                                region_size += 1
-                f.write(
-                    f'Connected component {region}, number of pixels = {region_size}\n')
-                components.append(component)
-                data_for_sort[0][region] = region_size
-    f.write(f'Total number of connected components = {region}')
-    f.close()
-    return mark, data_for_sort
-
-
-def detect_connected_components_sorted(*args, **kwargs):
-    '''
-    Sorts regions of connected components using an implementation of quick sort and outputs an image showing the two largest ones. 
-    Writes to a .txt file the outcome of the sorting. 
+    The binary map is labelled in a single linear pass (see label_components) and the size of every 
+    component is written to cc-output-2a.txt.
+
+    @param: image --> path to the red pixel binary map, the binary image returned by find_red_pixels, 
+                      or a 2D boolean mask (see colour_mask). Arrays are used as they are, without going through a file.
+    @param: connectivity --> optional keyword, 8 (default) or 4
+    @param: report --> optional keyword, file the sizes are written to (None to skip it)
+
+    @return: labels --> int32 label image, 0 for the background and one label per pavement region
+    @return: sizes --> number of pixels of each region, indexed by label
+    '''
+    labels, sizes = label_components(binary_mask(image), kwargs.get('connectivity', 8))
+    report = kwargs.get('report', 'cc-output-2a.txt')
+    if report:
+        write_component_report(sizes, report)
+    return labels, sizes
+
+
+def open_raster(path, shape=None, dtype=np.uint8):
+    '''
+    Opens a large raster as a read-only memory map, so only the parts being processed are loaded.
+
+    @param: path --> .npy file (shape and dtype are read from its header), or a raw file of pixels
+    @param: shape, dtype --> layout of a raw file, eg: (height, width, 4) and np.uint8
+    '''
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def export_raster(image_path, path):
+    '''
+    Saves an image as a uint8 .npy raster that open_raster can memory map.
+    '''
+    np.save(path, read_image(image_path))
+
+
+def iter_tiles(shape, tile):
+    '''
+    Yields the (rows, columns) slices of the tiles covering an image, in raster order.
 
-    @return: array of all the connected components belonging to the two largest regions. 
+    @param: shape --> (height, width, ...) of the image
+    @param: tile --> tile size, a single int for square tiles or (height, width)
     '''
-    data, lst_of_coords = detect_connected_components('map-red-pixels.jpg')[1]
-    out = list(data.items())
-    quick_sort(out, 0, len(out) - 1)
-    with open('cc-output-2b.txt', 'w+') as f:
-        for region, pixels in out:
-            f.write(
-                f'Connected component {region}, number of pixels = {pixels}\n')
-        f.write(f'Total number of connected components = {len(out)}')
+    tile_height, tile_width = (tile, tile) if np.isscalar(tile) else tile
+    for top in range(0, shape[0], tile_height):
+        for left in range(0, shape[1], tile_width):
+            yield slice(top, min(top + tile_height, shape[0])), slice(left, min(left + tile_width, shape[1]))
 
-    largest, second_largest = out[0][0], out[1][0]
-    arr = np.zeros((1140, 1053, 3))
-    for y, x in (lst_of_coords[largest-1] + lst_of_coords[second_largest - 1]):
-        arr[y][x] = (1, 1, 1)
-    mat_plot.imsave('cc-top-2.jpg', arr)
 
+def _tile_mask(source, rows, cols, colour):
+    block = source[rows, cols]
+    return np.asarray(block, dtype=bool) if block.ndim == 2 else colour_mask(read_image(block), colour)
+
+
+def tiled_colour_mask(raster, colour='red', tile=1024, out=None):
+    '''
+    Colour mask of a raster computed tile by tile (see colour_mask), so that only one tile 
+    of pixels is held in memory at a time.
+
+    @param: raster --> image array or memory map (see open_raster)
+    @param: colour --> name of a colour in COLOURS or channel ranges
+    @param: tile --> tile size
+    @param: out --> boolean array (or memory map) of shape (height, width) to write to, allocated when not given
+
+    @return: the boolean mask
+    '''
+    if out is None:
+        out = np.zeros(raster.shape[:2], dtype=bool)
+    for rows, cols in iter_tiles(raster.shape, tile):
+        out[rows, cols] = _tile_mask(raster, rows, cols, colour)
     return out
 
 
-def partition(items, low, high):
+def _seam_pairs(before, after, connectivity):
+    '''
+    Labels facing each other across a seam, given the two lines of labels on either side of it.
+    '''
+    pairs = [(before, after)]
+    if connectivity == 8:
+        pairs += [(before[:-1], after[1:]), (before[1:], after[:-1])]
+    a = np.concatenate([x for x, _ in pairs])
+    b = np.concatenate([y for _, y in pairs])
+    touching = (a > 0) & (b > 0) & (a != b)
+    return a[touching], b[touching]
+
+
+def _label_tile(source, rows, cols, colour, connectivity, out):
+    '''
+    Labels one tile on its own, writing its local labels to out.
+
+    @return: sizes --> pixels of each local label (from label 1)
+    @return: firsts --> raster index, in the whole image, of the first pixel of each local label
+    '''
+    labels, sizes = label_components(_tile_mask(source, rows, cols, colour), connectivity)
+    flat = labels.ravel()
+    pixels = np.flatnonzero(flat)
+    _, first = np.unique(flat[pixels], return_index=True)
+    tile_rows, tile_cols = np.divmod(pixels[first], labels.shape[1])
+    out[rows, cols] = labels
+    return sizes[1:], (tile_rows + rows.start) * out.shape[1] + tile_cols + cols.start
+
+
+def _merge_tiles(out, tiles, results, connectivity):
+    '''
+    Turns the local labels of every tile into the labels of the whole image (see tiled_label_components).
+
+    @param: out --> label image holding the local labels of each tile
+    @param: tiles --> (rows, cols) slices of the tiles
+    @param: results --> (sizes, firsts) returned by _label_tile for each tile
+    '''
+    sizes = [np.zeros(1, dtype=np.int64)]
+    firsts = [np.zeros(1, dtype=np.int64)]
+    count = 0
+    for (rows, cols), (tile_sizes, tile_firsts) in zip(tiles, results):
+        if count:
+            block = out[rows, cols]
+            out[rows, cols] = np.where(block > 0, block + count, 0)
+        sizes.append(tile_sizes)
+        firsts.append(tile_firsts)
+        count += len(tile_sizes)
+    sizes = np.concatenate(sizes)
+    firsts = np.concatenate(firsts)
+
+    seams_a, seams_b = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for top in sorted({rows.start for rows, _ in tiles} - {0}):
+        a, b = _seam_pairs(np.asarray(out[top - 1]), np.asarray(out[top]), connectivity)
+        seams_a.append(a)
+        seams_b.append(b)
+    for left in sorted({cols.start for _, cols in tiles} - {0}):
+        a, b = _seam_pairs(np.asarray(out[:, left - 1]), np.asarray(out[:, left]), connectivity)
+        seams_a.append(a)
+        seams_b.append(b)
+    roots = merge_roots(count + 1, np.concatenate(seams_a), np.concatenate(seams_b))
+
+    # Components are numbered by their first pixel in raster order, like label_components does.
+    first_pixel = np.full(count + 1, np.iinfo(np.int64).max)
+    np.minimum.at(first_pixel, roots[1:], firsts[1:])
+    components = np.flatnonzero(roots == np.arange(count + 1))[1:]
+    components = components[np.argsort(first_pixel[components])]
+    final = np.zeros(count + 1, dtype=np.int32)
+    final[components] = np.arange(1, len(components) + 1)
+    mapping = final[roots]
+    mapping[0] = 0
+
+    for rows, cols in tiles:
+        out[rows, cols] = mapping[out[rows, cols]]
+    final_sizes = np.bincount(mapping, weights=sizes, minlength=len(components) + 1).astype(np.int64)
+    final_sizes[0] = 0
+    return out, final_sizes
+
+
+def tiled_label_components(source, colour='red', tile=1024, connectivity=8, out=None):
+    '''
+    Connected component labelling of a raster too large to fit in memory, processed tile by tile.
+
+    Each tile is masked and labelled on its own (see label_components) with provisional labels. 
+    Components cut by tile seams are then merged with a union-find table built from the lines of labels 
+    on either side of each seam, and the labels are renumbered in raster scan order. 
+    The output is therefore identical to label_components on the whole mask.
+
+    @param: source --> image array or memory map (masked with colour), or a 2D boolean mask
+    @param: colour --> name of a colour in COLOURS or channel ranges, ignored for a 2D mask
+    @param: tile --> tile size
+    @param: connectivity --> 8 or 4
+    @param: out --> int32 array (or memory map) of shape (height, width) receiving the labels
+
+    @return: labels --> the label image (out when given)
+    @return: sizes --> number of pixels of each component, indexed by label
+    '''
+    if out is None:
+        out = np.zeros(source.shape[:2], dtype=np.int32)
+    tiles = list(iter_tiles(source.shape, tile))
+    results = [_label_tile(source, rows, cols, colour, connectivity, out) for rows, cols in tiles]
+    return _merge_tiles(out, tiles, results, connectivity)
+
+
+def _share(arr):
+    '''
+    Copies an array into a new shared memory block.
+
+    @return: the block, and the (name, shape, dtype) description workers use to attach to it
+    '''
+    block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[...] = arr
+    return block, (block.name, arr.shape, arr.dtype.str)
+
+
+def _attach(spec):
+    '''
+    Opens the array described by a worker spec: a .npy path (memory mapped) or a shared memory description.
+
+    @return: the array, and the shared memory block to close once done (None for a .npy file)
+    '''
+    if isinstance(spec, str):
+        return open_raster(spec), None
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf), block
+
+
+def _tile_worker(job):
+    '''
+    Runs one tile job in a worker process. Arrays are attached by name, never pickled.
+    '''
+    task, source_spec, out_spec, rows, cols, colour, connectivity = job
+    source, source_block = _attach(source_spec)
+    out, out_block = _attach(out_spec)
+    try:
+        if task == 'mask':
+            out[rows, cols] = _tile_mask(source, rows, cols, colour)
+            return None
+        return _label_tile(source, rows, cols, colour, connectivity, out)
+    finally:
+        del source, out
+        for block in (source_block, out_block):
+            if block is not None:
+                block.close()
+
+
+def _run_tiles(task, source, dtype, colour, tile, connectivity, workers):
+    '''
+    Fans the tile jobs out to a process pool. The source (unless it is a .npy path, which every worker 
+    memory maps) and the output live in shared memory.
+
+    @return: output array, tiles, and the result of each tile job in tile order
+    '''
+    blocks = []
+    try:
+        if isinstance(source, str):
+            source_spec = source
+            source_shape = open_raster(source).shape
+        else:
+            block, source_spec = _share(np.asarray(source))
+            blocks.append(block)
+            source_shape = source.shape
+        out = np.zeros(source_shape[:2], dtype=dtype)
+        block, out_spec = _share(out)
+        blocks.append(block)
+
+        tiles = list(iter_tiles(source_shape, tile))
+        jobs = [(task, source_spec, out_spec, rows, cols, colour, connectivity) for rows, cols in tiles]
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+            for result, counters in pool.map(functools.partial(worker_call, _tile_worker), jobs, chunksize=chunksize):
+                merge_counters(counters)
+                results.append(result)
+        out[...] = np.ndarray(out.shape, dtype=out.dtype, buffer=block.buf)
+        return out, tiles, results
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def parallel_colour_mask(source, colour='red', tile=1024, workers=None):
+    '''
+    Colour mask computed over tiles by a pool of worker processes (see tiled_colour_mask).
+
+    @param: source --> image array, or path to a .npy raster (see export_raster)
+    @param: workers --> number of processes, all the cores by default
+
+    @return: boolean mask
+    '''
+    return _run_tiles('mask', source, bool, colour, tile, None, workers)[0]
+
+
+def parallel_label_components(source, colour='red', tile=1024, connectivity=8, workers=None):
     '''
-    Used in the quick sort function below
+    Tiled connected component labelling (see tiled_label_components) where tiles are masked and labelled 
+    by a pool of worker processes. Tile pixels and labels go through shared memory rather than being pickled, 
+    then the seams are merged serially.
+
+    @param: source --> image array or 2D boolean mask, or path to a .npy raster (see export_raster)
+    @param: workers --> number of processes, all the cores by default
+
+    @return: labels, sizes --> same as label_components on the whole mask
+    '''
+    out, tiles, results = _run_tiles('label', source, np.int32, colour, tile, connectivity, workers)
+    return _merge_tiles(out, tiles, results, connectivity)
+
+
+def component_stats(labels, sizes=None):
+    '''
+    Size, bounding box and centroid of every component of a label image, computed with 
+    bincount-style reductions over the labelled pixels (no per-component loop).
+
+    @param: labels --> int label image, as returned by label_components
+    @param: sizes --> pixel counts indexed by label, recomputed from the labels when not given
+
+    @return: dictionary of arrays indexed by label (index 0, the background, is left empty):
+             'size', 'bbox' (min row, min col, max row, max col) and 'centroid' (row, col)
+    '''
+    rows, cols = np.nonzero(labels)
+    regions = labels[rows, cols]
+    count = int(labels.max(initial=0)) + 1
+    if sizes is None:
+        sizes = np.bincount(regions, minlength=count)
+        sizes[0] = 0
+
+    bbox = np.zeros((count, 4), dtype=np.int64)
+    bbox[:, :2] = np.iinfo(np.int64).max
+    np.minimum.at(bbox[:, 0], regions, rows)
+    np.minimum.at(bbox[:, 1], regions, cols)
+    np.maximum.at(bbox[:, 2], regions, rows)
+    np.maximum.at(bbox[:, 3], regions, cols)
+    bbox[0] = 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid = np.stack([np.bincount(regions, weights=rows, minlength=count),
+                             np.bincount(regions, weights=cols, minlength=count)], axis=1) / sizes[:, None]
+    centroid[0] = np.nan
+    return {'size': np.asarray(sizes), 'bbox': bbox, 'centroid': centroid}
+
+
+def top_components(sizes, k):
+    '''
+    Labels of the k largest components, largest first (ties go to the smaller label).
+    Only the k selected components are sorted, after a partial sort of all the sizes.
+
+    @param: sizes --> pixel counts indexed by label (index 0, the background, is ignored)
+    @param: k --> number of components to select
+    '''
+    sizes = np.asarray(sizes)[1:]
+    k = min(k, len(sizes))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Sorting on (-size, label) keeps the selection deterministic when sizes are equal
+    keys = -sizes.astype(np.int64) * (len(sizes) + 1) + np.arange(len(sizes))
+    selected = np.argpartition(keys, k - 1)[:k]
+    return selected[np.argsort(keys[selected])] + 1
+
+
+def render_components(labels, regions):
+    '''
+    Black RGB image of the label image's shape where the pixels of the chosen components are white.
+    '''
+    arr = np.zeros(labels.shape + (3,))
+    arr[np.isin(labels, regions)] = (1, 1, 1)
+    return arr
+
+
+def detect_connected_components_sorted(labels=None, sizes=None, *args, **kwargs):
+    '''
+    Sorts regions of connected components by size and outputs an image showing the largest ones (cc-top-2.jpg). 
+    Writes to a .txt file the outcome of the sorting. 
+
+    @param: labels, sizes --> output of detect_connected_components, which is run on map-red-pixels.jpg when not given
+    @param: k --> optional keyword, number of components shown in the image (2 by default)
+    @param: report, image --> optional keywords, files the sorted sizes and the image are written to (None to skip them)
+
+    @return: list of (region, number of pixels) for every component, largest first
+    '''
+    if labels is None:
+        labels, sizes = detect_connected_components('map-red-pixels.jpg')
+    elif sizes is None:
+        sizes = component_stats(labels)['size']
+
+    order = top_components(sizes, len(sizes) - 1)
+    report = kwargs.get('report', 'cc-output-2b.txt')
+    if report:
+        write_component_report(sizes, report, order)
+    image = kwargs.get('image', 'cc-top-2.jpg')
+    if image:
+        mat_plot.imsave(image, render_components(labels, order[:kwargs.get('k', 2)]))
+
+    return [(int(region), int(sizes[region])) for region in order]
+
+
+def map_pipeline(path, colour='red', connectivity=8, k=2, mask_file=None, report_file=None, image_file=None):
+    '''
+    Runs the whole analysis of a map in memory: the mask flows straight from colour masking to labelling 
+    and sorting, without being written to and read back from a (lossy) JPEG file. 
+    Files are only written when asked for.
+
+    @param: path --> path to the map, or the image array
+    @param: colour --> name of a colour in COLOURS or channel ranges
+    @param: connectivity --> 8 or 4
+    @param: k --> number of components rendered in image_file
+    @param: mask_file --> optional output for the mask (.png, or bit-packed .npz, see save_mask)
+    @param: report_file --> optional output for the sizes of the components, largest first
+    @param: image_file --> optional output for the image of the k largest components
+
+    @return: dictionary with the 'mask', 'labels', 'sizes' (indexed by label) and 'order' (labels, largest first)
     '''
-    pivot = items[high][1]
-    i = low
-    for j in range(low, high):
-        if items[j][1] > pivot:
-            items[i], items[j] = items[j], items[i]
-            i += 1
-    items[i], items[high] = items[high], items[i]
-    return i
+    mask = colour_mask(read_image(path), colour)
+    labels, sizes = label_components(mask, connectivity)
+    order = top_components(sizes, len(sizes) - 1)
+    if mask_file:
+        save_mask(mask, mask_file)
+    if report_file:
+        write_component_report(sizes, report_file, order)
+    if image_file:
+        mat_plot.imsave(image_file, render_components(labels, order[:k]))
+    return {'mask': mask, 'labels': labels, 'sizes': sizes, 'order': order}
 
 
-def quick_sort(items, low, high):
-    if low < high:
-        pivot_index = partition(items, low, high)
-        quick_sort(items, low, pivot_index - 1)
-        quick_sort(items, pivot_index + 1, high)
+instrument_module(__name__)
@@ -1,3 +1,8 @@
+import argparse
+import itertools
+import json
+import os
+
 import numpy as np
 from matplotlib import pyplot as mat_plot
 import datetime
@@ -5,6 +10,14 @@ import datetime
 from intelligence import *
 from reporting import *
 from monitoring import *
+from instrumentation import ENVIRONMENT_VARIABLE, enable
+
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+STATION_FILES = {'MY1': os.path.join(DATA_DIRECTORY, 'Pollution-London Marylebone Road.csv'),
+                 'KC1': os.path.join(DATA_DIRECTORY, 'Pollution-London N Kensington.csv'),
+                 'HRL': os.path.join(DATA_DIRECTORY, 'Pollution-London Harlington.csv')}
 
 
 def menu_setup(menu, mess):
@@ -37,12 +50,8 @@ def reporting_menu():
     It uses an input validation system to limit exceptions due to user input. 
 
     '''
-    with open(f'./data/Pollution-London Marylebone Road.csv') as f:
-        mary_data = f.read().split('\n')
-    with open(f'./data/Pollution-London N Kensington.csv') as f:
-        nken_data = f.read().split('\n')
-    with open(f'./data/Pollution-London Harlington.csv') as f:
-        harl_data = f.read().split('\n')
+    # Each file is parsed once into typed columns (then memory mapped from its binary cache on later runs).
+    mary_data, nken_data, harl_data = (load_station(path, code) for code, path in STATION_FILES.items())
 
     menu_setup(
         'Reporting', 'The PR Module uses data treatment functions to providing relevant information regarding the pollution levels at the different monitoring stations.')
@@ -56,13 +65,13 @@ def reporting_menu():
         station = input(
             'Enter your choice for the monitoring station: ').upper()
         if station == 'M':
-            data = mary_data
+            station, data = 'MY1', mary_data
             break
         elif station == 'N':
-            data = nken_data
+            station, data = 'KC1', nken_data
             break
         elif station == 'H':
-            data = harl_data
+            station, data = 'HRL', harl_data
             break
         else:
             print('Please input a valid option from the following choices: ')
@@ -76,6 +85,7 @@ def reporting_menu():
             break
         else:
             print('Please input a valid option from the following choices: ')
+    filled_data = False
     while True:
         print('\nNow, choose which function to run on your selected data:\n')
         print('1 - Daily averages for your given parameters (365 values).')
@@ -90,30 +100,30 @@ def reporting_menu():
 
         if choice == '7':
             new_val = input(
-                '\nWhat value would you like to replace the missing data with?\nPlease enter it here: ')
+                '\nWhat value would you like to replace the missing data with?\n(You can also enter ffill, linear or hourly_mean to estimate them.)\nPlease enter it here: ')
             data = fill_missing_data(data, new_val, station, pol)
             filled_data = True
             print('\nMissing data replaced.')
             input('\nPress enter to continue.')
 
-        elif not filled_data:
+        elif choice in ('1', '2', '3', '4', '5') and not filled_data:
             print('Please run the "Fill missing values" functions first, thank you.')
 
         elif choice == '1':
             print('\nDaily Average:')
-            print(daily_average(data, station, pol))
+            print(report_cache.run(daily_average, data, station, pol))
             input('\nPress enter to continue.')
         elif choice == '2':
             print('\nDaily Median:')
-            print(daily_median(data, station, pol))
+            print(report_cache.run(daily_median, data, station, pol))
             input('\nPress enter to continue.')
         elif choice == '3':
             print('\nHourly Average:')
-            print(hourly_average(data, station, pol))
+            print(report_cache.run(hourly_average, data, station, pol))
             input('\nPress enter to continue.')
         elif choice == '4':
             print('\nMonthly Average:')
-            print(monthly_average(data, station, pol))
+            print(report_cache.run(monthly_average, data, station, pol))
             input('\nPress enter to continue.')
         elif choice == '5':
             # Again, this loop is to make sure the user inputs a valid date, in the correct format.
@@ -122,7 +132,7 @@ def reporting_menu():
                     date = input(
                         '\nPlease input a date for the Peak Hour function (format is YYYY-MM-DD): ')
                     print()
-                    print(peak_hour_date(data, date, station, pol))
+                    print(report_cache.run(peak_hour_date, data, date, station, pol))
                     input('\nPress enter to continue.')
                     break
                 except:
@@ -130,7 +140,7 @@ def reporting_menu():
 
         elif choice == '6':
             print('\nNumber of Missing Data instances:')
-            print(count_missing_data(data, station, pol))
+            print(report_cache.run(count_missing_data, data, station, pol))
             input('\nPress enter to continue.')
         elif choice == 'Q':
             break
@@ -218,8 +228,7 @@ def monitoring_menu():
                 pol = input('Please choose a pollutant: ').upper()
                 if pol in ['NO', 'P10', 'P25']:
 
-                    data = treat_data(
-                        get_live_data_from_api(loc, pol, start_date))
+                    data = as_samples(get_cached_data(loc, pol, start_date))
                     break
                 else:
                     print('Please choose a valid option.')
@@ -246,6 +255,8 @@ def intelligence_menu():
     Only terminates if the user selects 'Q' from the menu
     '''
     image = './data/map.png'
+    binary = None
+    components = ()
 
     menu_setup('Mobility Intelligence',
                'The goal of the MI module is to provide visual support to the analyses of road infrastructure in one of the stations.')
@@ -259,15 +270,19 @@ def intelligence_menu():
         print('Q - Exit the intelligence menu')
         choice = input('Choose a function to run: ').upper()
         if choice == 'R':
-            find_red_pixels(image)
-            binary = True
+            # The binary image is kept in memory for the detection, the saved JPEG is only for the user
+            binary = find_red_pixels(image)
+            components = ()
         elif choice == 'C':
             find_cyan_pixels(image)
-        elif choice == 'D' and binary:
-            detect_connected_components('map-red-pixels.jpg')
+        elif choice == 'D' and binary is not None:
+            components = detect_connected_components(binary)
 
-        elif choice == 'S' and binary:
-            detect_connected_components_sorted()
+        elif choice == 'S' and binary is not None:
+            # Reuses the labels of the detection when it has already been run
+            if not components:
+                components = detect_connected_components(binary, report=None)
+            detect_connected_components_sorted(*components)
 
         elif choice == 'D' or choice == 'S':
             print('Try again after having run the red pixel detection function.')
@@ -293,5 +308,104 @@ def quit():
     input('\n\nThank you for using the ACQUA platform for your data analysis needs.\n')
 
 
+def batch_jobs(spec):
+    '''
+    Expands a job spec into the list of its jobs.
+
+    @param: spec --> dictionary with the 'stations' (codes of STATION_FILES or paths to csv files), 
+                     'pollutants' and 'reports' (see reporting.parse_report) to run, all of them by default
+
+    @return: list of (station, pollutant, report), stations first
+    '''
+    stations = spec.get('stations') or list(STATION_FILES)
+    pollutants = spec.get('pollutants') or list(StationData.pollutants)
+    reports = spec.get('reports') or list(REPORTS)
+    for report in reports:
+        parse_report(report)  # Fails before anything is loaded
+    return list(itertools.product(stations, pollutants, reports))
+
+
+def station_name(station):
+    '''
+    Code of a station given by its code or by the path of its csv file.
+    '''
+    return station if station in STATION_FILES else os.path.splitext(os.path.basename(station))[0]
+
+
+def write_report(result, path, fmt='csv'):
+    '''
+    Writes the output of reporting.run_report to a csv file (one row per bucket, 'No data' for NaN) 
+    or to a json file (one list per column, null for NaN).
+    '''
+    columns = {key: value.astype(str).tolist() if value.dtype.kind == 'M' else value.tolist()
+               for key, value in result.items()}
+    columns = {key: [None if value != value else value for value in values] for key, values in columns.items()}
+    names = (['bucket'] if 'bucket' in columns else []) + [key for key in columns if key != 'bucket']
+    with open(path, 'w') as f:
+        if fmt == 'json':
+            json.dump({name: columns[name] for name in names}, f)
+        else:
+            f.write(','.join(names) + '\n')
+            for row in zip(*(columns[name] for name in names)):
+                f.write(','.join(MISSING if value is None else str(value) for value in row) + '\n')
+
+
+def run_batch(spec):
+    '''
+    Runs a job spec (see batch_jobs) without any user input. The jobs are run by reporting.run_report_jobs,
+    which loads each station file once, and every (station, pollutant, report) job is written to its own file.
+
+    @param: spec --> dictionary with 'stations', 'pollutants' and 'reports' (see batch_jobs), and optionally:
+                     'format' ('csv' or 'json'), 'output' (directory, 'reports' by default),
+                     'fill' (value or strategy filling the missing data first, see fill_missing_data) 
+                     and 'workers' (number of worker processes, 1 by default)
+
+    @return: list of the paths written, in the order of the jobs
+    '''
+    fmt = spec.get('format', 'csv')
+    if fmt not in ('csv', 'json'):
+        raise ValueError(f'Unknown output format {fmt!r}')
+    jobs = batch_jobs(spec)
+    output = spec.get('output') or 'reports'
+    os.makedirs(output, exist_ok=True)
+
+    results = run_report_jobs([(STATION_FILES.get(station, station), pol, report) for station, pol, report in jobs],
+                              spec.get('workers') or 1, spec.get('fill'))
+    paths = []
+    for (station, pol, report), result in zip(jobs, results):
+        path = os.path.join(output, f"{station_name(station)}-{pol}-{report.replace(':', '_').replace(',', '-')}.{fmt}")
+        write_report(result, path, fmt)
+        paths.append(path)
+    return paths
+
+
 if __name__ == '__main__':
-    main_menu()
+    parser = argparse.ArgumentParser(description='ACQUA air pollution data analytics platform.')
+    parser.add_argument('--instrument', metavar='FILE',
+                        help=f'record the timings of every call to FILE as JSON lines, or as a cProfile dump for a .prof file '
+                             f'(same as setting {ENVIRONMENT_VARIABLE})')
+    batch = parser.add_argument_group('batch mode', 'run reports without any menu, eg: from a cron job')
+    batch.add_argument('--batch', action='store_true', help='run the job spec given by the options below and exit')
+    batch.add_argument('--spec', metavar='FILE', help='json job spec, the other options override its entries')
+    batch.add_argument('--stations', nargs='+', help=f'station codes ({", ".join(STATION_FILES)}) or csv files')
+    batch.add_argument('--pollutants', nargs='+', choices=StationData.pollutants)
+    batch.add_argument('--reports', nargs='+', help=f'{", ".join(REPORTS)}, count_missing_data or eg: week:mean,max,p95')
+    batch.add_argument('--format', choices=('csv', 'json'))
+    batch.add_argument('--output', metavar='DIR', help='directory the reports are written to (reports by default)')
+    batch.add_argument('--fill', help='value or strategy (ffill, linear, hourly_mean) filling missing data first')
+    batch.add_argument('--workers', type=int, help='number of worker processes running the jobs')
+    args = parser.parse_args()
+    if args.instrument:
+        enable(args.instrument)
+    if args.batch:
+        spec = {}
+        if args.spec:
+            with open(args.spec) as f:
+                spec = json.load(f)
+        for key in ('stations', 'pollutants', 'reports', 'format', 'output', 'fill', 'workers'):
+            if getattr(args, key) is not None:
+                spec[key] = getattr(args, key)
+        for path in run_batch(spec):
+            print(path)
+    else:
+        main_menu()
@@ -1,6 +1,122 @@
 import requests
+import heapq
 import datetime
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import matplotlib.pyplot as plt
+import numpy as np
+from requests.adapters import HTTPAdapter
+
+from instrumentation import instrument_module, record
+
+
+API_URL = 'https://api.erg.ic.ac.uk/AirQuality'  # Base url of the LondonAir API
+
+
+def api_url(site_code, species_code, start_date, end_date, base_url=API_URL):
+    '''
+    Url of the LondonAir endpoint returning the hourly data of one species at one site.
+    '''
+    return f"{base_url}/Data/SiteSpecies/SiteCode={site_code}/SpeciesCode={species_code}/StartDate={start_date}/EndDate={end_date}/Json"
+
+
+class LondonAirClient:
+    '''
+    Client for the LondonAir API fetching many (site, species, time frame) jobs concurrently.
+    Requests go through one requests.Session, whose connection pool keeps connections alive between calls, 
+    and are run by a thread pool bounded by the concurrency limit.
+
+    @param: base_url --> root of the API (eg: the url of a local stub server in tests)
+    @param: max_concurrency --> maximum number of requests in flight at once
+    @param: timeout --> seconds to wait for the server before giving up on an attempt
+    @param: retries --> attempts made after the first one fails on a connection error, timeout or 5xx/429 status
+    @param: backoff --> wait before the first retry in seconds, doubled after every attempt
+    '''
+
+    def __init__(self, base_url=API_URL, max_concurrency=8, timeout=10, retries=3, backoff=0.5):
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown()
+        self.session.close()
+
+    def fetch(self, site_code='MY1', species_code='NO', start_date=None, end_date=None):
+        '''
+        Fetches the raw JSON data of one species at one site, retrying with exponential backoff.
+
+        @param: start_date and end_date --> time frame, today until tomorrow by default
+
+        @return: decoded JSON payload (see treat_data)
+        '''
+        start = datetime.date.today() if start_date is None else start_date
+        end = datetime.date.today() + datetime.timedelta(days=1) if end_date is None else end_date
+        url = api_url(site_code, species_code, start, end, self.base_url)
+
+        for attempt in range(self.retries + 1):
+            try:
+                res = self.session.get(url, timeout=self.timeout)
+                if res.status_code < 500 and res.status_code != 429:
+                    res.raise_for_status()
+                    record(bytes_read=len(res.content))
+                    return res.json()
+                error = requests.HTTPError(f'{res.status_code} error for {url}', response=res)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = exc
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise error
+
+    def fetch_many(self, jobs, return_exceptions=False):
+        '''
+        Fetches several jobs concurrently.
+
+        @param: jobs --> iterable of (site_code, species_code) or (site_code, species_code, start_date, end_date)
+        @param: return_exceptions --> if True, a failed job gives its exception instead of raising it
+
+        @return: list of payloads, in the order of the jobs
+        '''
+        futures = [self._pool.submit(self.fetch, *job) for job in jobs]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as exc:
+                if not return_exceptions:
+                    raise
+                results.append(exc)
+        return results
+
+
+_client = None
+
+
+def get_client():
+    '''
+    Returns the client shared by the monitoring functions, created on first use.
+    '''
+    global _client
+    if _client is None:
+        _client = LondonAirClient()
+    return _client
 
 
 def get_live_data_from_api(site_code='MY1', species_code='NO', start_date=None, end_date=None):
@@ -11,14 +127,7 @@ def get_live_data_from_api(site_code='MY1', species_code='NO', start_date=None,
     @param: species_code --> pollution for which to draw data
     @param: start_date and end_date --> determine the time frame for which to draw data. 
     """
-    start = datetime.date.today() if start_date is None else start_date
-    end = datetime.date.today() + datetime.timedelta(days=1)
-
-    url = f"https://api.erg.ic.ac.uk/AirQuality/Data/SiteSpecies/SiteCode={site_code}/SpeciesCode={species_code}/StartDate={start}/EndDate={end}/Json"
-
-    res = requests.get(url)
-    print(res)
-    return res.json()
+    return get_client().fetch(site_code, species_code, start_date, end_date)
 
 
 def treat_data(raw_data):
@@ -33,7 +142,7 @@ def treat_data(raw_data):
 
     out = []
     for line in data:
-        hour, val = line.values()
+        hour, val = line['@MeasurementDateGMT'], line['@Value']
         if not val:
             out.append([hour, 'N/A'])
             continue
@@ -42,37 +151,340 @@ def treat_data(raw_data):
     return out
 
 
+SAMPLE_DTYPE = np.dtype([('time', 'datetime64[h]'), ('value', np.float64)])  # Hourly samples of one feed
+
+
+def decode_payload(raw_data):
+    '''
+    Decodes an API payload once into a NumPy structured array of hourly samples.
+
+    @param: raw_data --> output from live data function
+
+    @return: array of SAMPLE_DTYPE: 'time' (datetime64[h]) and 'value' (NaN when missing)
+    '''
+    data = raw_data['RawAQData']['Data']
+    out = np.empty(len(data), dtype=SAMPLE_DTYPE)
+    out['time'] = np.array([line['@MeasurementDateGMT'] for line in data], dtype='datetime64[h]')
+    out['value'] = np.array([line['@Value'] or 'nan' for line in data], dtype=np.float64)
+    return out
+
+
+def as_samples(data):
+    '''
+    Adapter returning hourly samples (see decode_payload) from a raw payload, from the list of lists 
+    of treat_data, or from samples (returned as they are).
+    '''
+    if isinstance(data, np.ndarray) and data.dtype == SAMPLE_DTYPE:
+        return data
+    if isinstance(data, dict):
+        return decode_payload(data)
+    out = np.empty(len(data), dtype=SAMPLE_DTYPE)
+    out['time'] = np.array([line[0] for line in data], dtype='datetime64[h]')
+    out['value'] = np.array([np.nan if line[1] == 'N/A' else line[1] for line in data], dtype=np.float64)
+    return out
+
+
+def time_labels(times):
+    '''
+    Formats datetime64 timestamps the way the API does (eg: 2023-01-02 13:00:00).
+    '''
+    return np.char.replace(np.datetime_as_string(times.astype('datetime64[s]')), 'T', ' ')
+
+
+class ResponseCache:
+    '''
+    On-disk cache of treated API data, stored per (site, species, day) as JSON files.
+
+    A day fetched after its end (GMT) can no longer change, so it is kept for good. A day fetched while 
+    its hours were still being published (eg: cached as today, then read again next week) is only 
+    used for ttl seconds. A request for a time frame fetches 
+    just the days that are missing or stale (one API call per run of consecutive days) and merges them 
+    with the cached ones.
+
+    @param: directory --> folder holding the cache
+    @param: ttl --> seconds during which the data of a day fetched before its end is reused
+    @param: client --> LondonAirClient used for the missing days (the shared client by default)
+    '''
+
+    def __init__(self, directory='.londonair-cache', ttl=300, client=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.client = client
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, site_code, species_code, day):
+        return os.path.join(self.directory, site_code, species_code, f'{day}.json')
+
+    def _load(self, site_code, species_code, day):
+        try:
+            with open(self._path(site_code, species_code, day)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(), datetime.timezone.utc)
+        if cached['fetched'] < end.timestamp() and time.time() - cached['fetched'] > self.ttl:
+            return None
+        return cached['rows']
+
+    def _store(self, site_code, species_code, day, rows):
+        path = self._path(site_code, species_code, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'fetched': time.time(), 'rows': rows}, f)
+        os.replace(path + '.tmp', path)
+
+    def fetch_many(self, jobs):
+        '''
+        Treated data for several (site_code, species_code, start_date[, end_date]) jobs. 
+        The missing days of all the jobs are fetched concurrently.
+
+        @return: list with the treat_data output of each job, in order
+        '''
+        today = datetime.date.today()
+        plans = []
+        requests_needed = []
+        for job in jobs:
+            site_code, species_code, start = job[:3]
+            start = today if start is None else start
+            end = job[3] if len(job) > 3 and job[3] is not None else today + datetime.timedelta(days=1)
+            days = [start + datetime.timedelta(days=i) for i in range((end - start).days)]
+            cached = {day: self._load(site_code, species_code, day) for day in days}
+            missing = [day for day in days if cached[day] is None]
+            self.hits += len(days) - len(missing)
+            self.misses += len(missing)
+            # Consecutive missing days are fetched in a single call
+            runs = []
+            for day in missing:
+                if runs and runs[-1][1] == day:
+                    runs[-1][1] = day + datetime.timedelta(days=1)
+                else:
+                    runs.append([day, day + datetime.timedelta(days=1)])
+            plans.append((site_code, species_code, days, cached, len(requests_needed), len(runs)))
+            requests_needed += [(site_code, species_code, first, stop) for first, stop in runs]
+
+        client = self.client or get_client()
+        fetched = client.fetch_many(requests_needed)
+
+        out = []
+        for site_code, species_code, days, cached, first, count in plans:
+            fetched_days = {}
+            for raw in fetched[first:first + count]:
+                for row in treat_data(raw):
+                    fetched_days.setdefault(row[0][:10], []).append(row)
+            for day in days:
+                if cached[day] is None:
+                    # A day without any row in the response is stored empty
+                    cached[day] = fetched_days.get(str(day), [])
+                    self._store(site_code, species_code, day, cached[day])
+            out.append([row for day in days for row in cached[day]])
+        return out
+
+    def fetch(self, site_code='MY1', species_code='NO', start_date=None, end_date=None):
+        '''
+        Treated data of one species at one site over a time frame (today by default), see fetch_many.
+        '''
+        return self.fetch_many([(site_code, species_code, start_date, end_date)])[0]
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    '''
+    Returns the response cache shared by the monitoring functions, created on first use.
+    '''
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+def get_cached_data(site_code='MY1', species_code='NO', start_date=None, end_date=None):
+    '''
+    Same output as treat_data(get_live_data_from_api(...)), served from the response cache where possible.
+    '''
+    return get_response_cache().fetch(site_code, species_code, start_date, end_date)
+
+
+class SampleBuffer:
+    '''
+    Growable ring buffer of (datetime64[h], float32) samples.
+    Storage is preallocated and doubled when full, up to max_size samples; past that the oldest 
+    samples are overwritten.
+
+    Running statistics of every sample appended since creation (count, sum, minimum, maximum, latest) 
+    are updated in O(new samples) by append().
+
+    @param: capacity --> initial number of preallocated samples
+    @param: max_size --> maximum number of samples kept
+    '''
+
+    def __init__(self, capacity=256, max_size=24*366):
+        self.max_size = max_size
+        self.times = np.zeros(min(capacity, max_size), dtype='datetime64[h]')
+        self.values = np.zeros(len(self.times), dtype=np.float32)
+        self.start = 0
+        self.size = 0
+        self.count = 0
+        self.total = 0.0
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self.latest = None
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, needed):
+        capacity = len(self.times)
+        if needed <= capacity or capacity == self.max_size:
+            return
+        times, values = self.window()
+        capacity = min(max(needed, 2 * capacity), self.max_size)
+        self.times = np.zeros(capacity, dtype='datetime64[h]')
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.times[:self.size] = times
+        self.values[:self.size] = values
+        self.start = 0
+
+    def append(self, times, values):
+        '''
+        Appends samples (in chronological order) and updates the running statistics.
+        '''
+        times = np.asarray(times, dtype='datetime64[h]')[-self.max_size:]
+        values = np.asarray(values, dtype=np.float32)[-self.max_size:]
+        if len(times) == 0:
+            return
+        self._grow(self.size + len(times))
+        capacity = len(self.times)
+        positions = (self.start + self.size + np.arange(len(times))) % capacity
+        self.times[positions] = times
+        self.values[positions] = values
+        overflow = max(0, self.size + len(times) - capacity)
+        self.start = (self.start + overflow) % capacity
+        self.size = min(capacity, self.size + len(times))
+
+        valid = values[~np.isnan(values)]
+        if len(valid):
+            self.count += len(valid)
+            self.total += float(valid.sum(dtype=np.float64))
+            self.minimum = float(np.fmin(self.minimum, valid.min()))
+            self.maximum = float(np.fmax(self.maximum, valid.max()))
+        self.latest = (times[-1], float(values[-1]))
+
+    def window(self):
+        '''
+        Copies of the samples held, oldest first.
+        '''
+        positions = (self.start + np.arange(self.size)) % max(len(self.times), 1)
+        return self.times[positions], self.values[positions]
+
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+
+class IncrementalIngester:
+    '''
+    Long-running ingestion of live data: remembers the last hour seen for every (site, species) feed, 
+    only asks the API for the days from that hour onwards, and appends the newer hours to the feed's 
+    SampleBuffer. Hours without a value are not consumed while they may still be published: neither trailing 
+    ones nor anything from the first missing hour of the last lookback hours, which are fetched again later.
+
+    @param: client --> LondonAirClient (the shared client by default)
+    @param: start_date --> first day fetched for a new feed, today by default
+    @param: max_size --> number of samples kept per feed
+    @param: lookback --> hours during which a missing value may still be published
+    '''
+
+    def __init__(self, client=None, start_date=None, max_size=24*366, lookback=24):
+        self.client = client
+        self.start_date = start_date
+        self.max_size = max_size
+        self.lookback = lookback
+        self.last_seen = {}
+        self.buffers = {}
+
+    def poll(self, site_code='MY1', species_code='NO'):
+        '''
+        Fetches and appends the new hours of one feed.
+
+        @return: number of new samples
+        '''
+        return self.poll_many([(site_code, species_code)])[0]
+
+    def poll_many(self, feeds):
+        '''
+        Fetches the new hours of several (site, species) feeds concurrently.
+
+        @return: number of new samples of each feed
+        '''
+        today = datetime.date.today()
+        jobs = []
+        for feed in feeds:
+            last = self.last_seen.get(feed)
+            start = (self.start_date or today) if last is None else last.astype('datetime64[D]').astype(datetime.date)
+            jobs.append((*feed, start, today + datetime.timedelta(days=1)))
+
+        # Older missing hours are final; newer ones hold back every hour after them, so last_seen stays before them
+        horizon = np.datetime64(datetime.datetime.now(), 'h') - np.timedelta64(self.lookback, 'h')
+        client = self.client or get_client()
+        added = []
+        for feed, raw in zip(feeds, client.fetch_many(jobs)):
+            samples = decode_payload(raw)
+            times, values = samples['time'], samples['value']
+            missing = np.isnan(values)
+            published = np.flatnonzero(~missing)
+            pending = np.flatnonzero(missing & (times >= horizon))
+            end = published[-1] + 1 if len(published) else 0
+            if len(pending):
+                end = min(end, pending[0])
+            times, values = times[:end], values[:end]
+            last = self.last_seen.get(feed)
+            if last is not None:
+                newer = times > last
+                times, values = times[newer], values[newer]
+            if feed not in self.buffers:
+                self.buffers[feed] = SampleBuffer(max_size=self.max_size)
+            self.buffers[feed].append(times, values)
+            if len(times):
+                self.last_seen[feed] = times[-1]
+            added.append(len(times))
+        return added
+
+
+def quantile(ordered, q):
+    '''
+    Quantile of a sorted list with linear interpolation between the closest ranks (same as np.percentile).
+    '''
+    position = q * (len(ordered) - 1)
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
 def check_risk_in_area(data):
     '''
     This function uses the statistical "outlier" method to detect a risk in a given area.
     It takes the values at the lower quartile and upper quartile of the data for the given pollutant to figure out the interquartile range (IQR).
     If any of of the values are greater than Q3 + 1.5*IQR, the area in which it is found is flagged as "At Risk".
 
-    @param: pol -> The choice of pollutant for which the data is checked.
-    @param: mdata, kdata, hdata -> treated data from each location.
+    @param: data -> samples (see decode_payload) or treated data (see treat_data) for one pollutant at one location.
 
-    @return: If there is an outlier -> location(s) and time at which happened
+    @return: If there is an outlier -> list of (value, time) for each of them
     '''
-    arr = [(line[1], line[0])
-           for line in data if type(line[1]) == float].sort()
+    if isinstance(data, np.ndarray):
+        valid = data[~np.isnan(data['value'])]
+        arr = sorted(zip(valid['value'].tolist(), time_labels(valid['time']).tolist()))
+    else:
+        arr = sorted((line[1], line[0]) for line in data if type(line[1]) == float)
 
-    if arr is None or len(arr) < 5:
+    if len(arr) < 5:
         print('\nThere isn\'t enough data for your pollutant in the station you chose. \nPlease run the function again with different choices (eg: Marylebone Road, NO)\n')
         return 'Failed due to lack of data'
-    median = arr[len(arr)//2]
-    q1 = len(arr)//4
-    q3 = len(arr)//2 + len(arr)//4
-
-    # For the cases where the array is of odd length, the values are incremented by 1 as we used integer division for their definition.
-    if len(arr) % 2 != 0:
-        median, q1, q3 = list(
-            map(lambda x: x + 1, [x for x in (median, q1, q3)]))
-
-    iqr = arr[q3][0] - arr[q1][1]
-    outliers = []
-    for i in arr[q3:]:
-        if i[0] >= arr[q3][0] + 1.5*iqr:
-            outliers.append(i)
+    values = [val for val, _ in arr]
+    q1, median, q3 = (quantile(values, q) for q in (0.25, 0.5, 0.75))
+    iqr = q3 - q1
+    outliers = [(val, date) for val, date in arr if val > q3 + 1.5*iqr]
     print(
         f'\nThe median value for this set of data is {median}. \nThe interquartile range is {iqr}.')
     max_val, max_time = arr[-1]
@@ -86,6 +498,256 @@ def check_risk_in_area(data):
     return outliers
 
 
+class _LazyHeap:
+    '''
+    Min-heap (or max-heap with sign=-1) of (value, id) entries belonging to one group of a _WindowQuartiles.
+    Entries whose id has moved to another group (or left the window) are only dropped when they reach the top.
+    '''
+
+    def __init__(self, group, groups, sign=1):
+        self.group = group
+        self.groups = groups  # Shared mapping id --> current group
+        self.sign = sign
+        self.entries = []
+
+    def push(self, value, key, live):
+        heapq.heappush(self.entries, (self.sign * value, key))
+        if len(self.entries) > 2 * live + 64:
+            # Rebuilt once stale entries dominate (live is the size of the group), which keeps the cost amortised
+            self.entries = [entry for entry in self.entries if self.groups.get(entry[1]) == self.group]
+            heapq.heapify(self.entries)
+
+    def top(self):
+        while self.groups.get(self.entries[0][1]) != self.group:
+            heapq.heappop(self.entries)
+        value, key = self.entries[0]
+        return self.sign * value, key
+
+
+class _WindowQuartiles:
+    '''
+    Multiset answering Q1 and Q3 (with the interpolation of quantile()) in O(log n) per insertion or removal.
+
+    Values are split into three groups, every value of L <= every value of M <= every value of H, sized so 
+    that the rank below Q1 is the maximum of L and the rank above Q3 the minimum of H. The ranks next to 
+    them are then the extremes of M (or of the neighbouring group when M is empty). Each group lives in 
+    heaps with lazy deletion, and every change only moves a constant number of values between groups.
+    '''
+
+    def __init__(self):
+        self.groups = {}
+        self.sizes = {'L': 0, 'M': 0, 'H': 0}
+        self.low = _LazyHeap('L', self.groups, -1)
+        self.mid_min = _LazyHeap('M', self.groups)
+        self.mid_max = _LazyHeap('M', self.groups, -1)
+        self.high = _LazyHeap('H', self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def _place(self, value, key, group):
+        self.groups[key] = group
+        self.sizes[group] += 1
+        live = self.sizes[group]
+        if group == 'L':
+            self.low.push(value, key, live)
+        elif group == 'H':
+            self.high.push(value, key, live)
+        else:
+            self.mid_min.push(value, key, live)
+            self.mid_max.push(value, key, live)
+
+    def _move(self, heap, group):
+        value, key = heap.top()
+        self.sizes[self.groups[key]] -= 1
+        self._place(value, key, group)
+
+    def _targets(self):
+        n = len(self.groups)
+        return int(0.25 * (n - 1)) + 1, n - 1 - int(0.75 * (n - 1))
+
+    def _rebalance(self):
+        low_size, high_size = self._targets()
+        while self.sizes['L'] > low_size:
+            self._move(self.low, 'M')
+        while self.sizes['L'] < low_size:
+            self._move(self.mid_min if self.sizes['M'] else self.high, 'L')
+        while self.sizes['H'] > high_size:
+            self._move(self.high, 'M')
+        while self.sizes['H'] < high_size:
+            self._move(self.mid_max, 'H')
+
+    def add(self, value, key):
+        if self.sizes['L'] and value <= self.low.top()[0]:
+            self._place(value, key, 'L')
+        elif self.sizes['H'] and value >= self.high.top()[0]:
+            self._place(value, key, 'H')
+        else:
+            self._place(value, key, 'M')
+        self._rebalance()
+
+    def remove(self, key):
+        self.sizes[self.groups.pop(key)] -= 1
+        self._rebalance()
+
+    def quartiles(self):
+        '''
+        (Q1, Q3) of the values, same as quantile() on the sorted values.
+        '''
+        n = len(self.groups)
+        below_q1 = self.low.top()[0]
+        above_q1 = self.mid_min.top()[0] if self.sizes['M'] else (self.high.top()[0] if self.sizes['H'] else below_q1)
+        above_q3 = self.high.top()[0] if self.sizes['H'] else None
+        below_q3 = self.mid_max.top()[0] if self.sizes['M'] else below_q1
+        out = []
+        for q, below, above in ((0.25, below_q1, above_q1), (0.75, below_q3, above_q3)):
+            position = q * (n - 1)
+            fraction = position - int(position)
+            out.append(below if above is None or not fraction else below + (above - below) * fraction)
+        return tuple(out)
+
+
+class RiskDetector:
+    '''
+    Online version of check_risk_in_area over a sliding window of the latest hourly samples.
+    The window is held in arrival order (to evict the oldest sample) and in a _WindowQuartiles, 
+    so each update costs O(log window) instead of re-sorting the window.
+
+    @param: window --> number of samples the quartiles are computed from (one week of hours by default)
+    @param: min_samples --> samples needed in the window before anything is flagged
+    @param: factor --> a sample is at risk when above Q3 + factor * IQR
+    '''
+
+    def __init__(self, window=168, min_samples=5, factor=1.5):
+        self.window = window
+        self.min_samples = min_samples
+        self.factor = factor
+        self._arrivals = deque()
+        self._quartiles = _WindowQuartiles()
+        self._count = 0  # Samples seen, used as the id of each of them
+        self.alerts = []
+
+    def __len__(self):
+        return len(self._quartiles)
+
+    def threshold(self):
+        '''
+        Current Q3 + factor * IQR, or None while the window holds fewer than min_samples samples.
+        '''
+        if len(self._quartiles) < max(self.min_samples, 1):
+            return None
+        q1, q3 = self._quartiles.quartiles()
+        return q3 + self.factor * (q3 - q1)
+
+    def update(self, time, value):
+        '''
+        Checks a new sample against the current window, then adds it to the window. Missing values are ignored.
+
+        @return: True if the sample is an outlier (it is also recorded in alerts)
+        '''
+        if value is None or value != value:
+            return False
+        limit = self.threshold()
+        at_risk = limit is not None and value > limit
+        if at_risk:
+            self.alerts.append((time, value, limit))
+
+        self._arrivals.append(self._count)
+        self._quartiles.add(value, self._count)
+        self._count += 1
+        if len(self._arrivals) > self.window:
+            self._quartiles.remove(self._arrivals.popleft())
+        return at_risk
+
+
+class RiskMonitor:
+    '''
+    One RiskDetector per (site, species) feed, so that many feeds can be watched at once.
+
+    @param: config --> optional dictionary mapping (site, species) to RiskDetector keyword arguments
+    @param: defaults --> keyword arguments for the feeds without a configuration
+    '''
+
+    def __init__(self, config=None, **defaults):
+        self.config = config or {}
+        self.defaults = defaults
+        self.detectors = {}
+
+    def detector(self, site_code, species_code):
+        feed = (site_code, species_code)
+        if feed not in self.detectors:
+            self.detectors[feed] = RiskDetector(**{**self.defaults, **self.config.get(feed, {})})
+        return self.detectors[feed]
+
+    def update(self, site_code, species_code, time, value):
+        '''
+        @return: True if the new sample of the feed is an outlier
+        '''
+        return self.detector(site_code, species_code).update(time, value)
+
+    def update_many(self, site_code, species_code, times, values):
+        '''
+        Feeds several samples of one feed in order (eg: the new samples of an IncrementalIngester poll).
+
+        @return: list of (time, value) for the samples flagged as outliers
+        '''
+        detector = self.detector(site_code, species_code)
+        return [(time, value) for time, value in zip(times, values) if detector.update(time, float(value))]
+
+
+def live_snapshot(sites, species, start_date=None, end_date=None, cache=None, factor=1.5):
+    '''
+    Fetches every (site, species) series concurrently and aligns them on one shared hourly time index.
+
+    @param: sites --> list of site codes (eg: ['MY1', 'KC1', 'HRL'])
+    @param: species --> list of species codes (eg: ['NO', 'PM10', 'PM25'])
+    @param: start_date, end_date --> time frame, as in get_live_data_from_api
+    @param: cache --> ResponseCache to fetch from (the shared one by default)
+    @param: factor --> IQR multiplier of the risk threshold (see check_risk_in_area)
+
+    @return: dict with 'sites', 'species', 'hours' (datetime64[h]), 
+             'values' (site x species x hour, NaN when missing), 'risk' (same shape, value > Q3 + factor*IQR)
+             and per (site x species) cell: 'count', 'mean', 'max', 'latest' (NaN when empty) and 'at_risk'
+    '''
+    sites, species = list(sites), list(species)
+    cache = cache or get_response_cache()
+    rows = cache.fetch_many([(site, pol, start_date, end_date) for site in sites for pol in species])
+    series = [as_samples(data) for data in rows]
+
+    # The grid covers the whole requested window (same defaults as the cache), whatever hours were published
+    today = datetime.date.today()
+    start = np.datetime64(today if start_date is None else start_date, 'h')
+    end = np.datetime64(today + datetime.timedelta(days=1) if end_date is None else end_date, 'h')
+    hours = np.arange(start, end, dtype='datetime64[h]')
+    values = np.full((len(sites) * len(species), len(hours)), np.nan)
+    for cell, samples in zip(values, series):
+        inside = (samples['time'] >= start) & (samples['time'] < end)
+        cell[(samples['time'][inside] - start).astype(int)] = samples['value'][inside]
+    values = values.reshape(len(sites), len(species), len(hours))
+
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, values, 0).sum(axis=-1) / count
+    maximum = np.where(count > 0, np.where(valid, values, -np.inf).max(axis=-1, initial=-np.inf), np.nan)
+    # Value at the last valid hour of every cell
+    latest = np.full(count.shape, np.nan)
+    if len(hours):
+        last = len(hours) - 1 - np.argmax(valid[..., ::-1], axis=-1)
+        latest = np.where(count > 0, np.take_along_axis(values, last[..., None], axis=-1)[..., 0], np.nan)
+
+    # Same rule as check_risk_in_area, evaluated on all the cells at once
+    risk = np.zeros(values.shape, dtype=bool)
+    enough = count >= 5
+    if enough.any():
+        q1, q3 = np.nanpercentile(values[enough], (25, 75), axis=-1)
+        with np.errstate(invalid='ignore'):
+            risk[enough] = values[enough] > (q3 + factor * (q3 - q1))[:, None]
+
+    return {'sites': sites, 'species': species, 'hours': hours, 'values': values, 'risk': risk,
+            'count': count, 'mean': mean, 'max': maximum, 'latest': latest, 'at_risk': risk.any(axis=-1)}
+
+
 def display_stats_location(loc, start_date):
     '''
     Returns a readable output of live data from all pollutants in a chosen station. Takes into account missing data points. 
@@ -96,18 +758,12 @@ def display_stats_location(loc, start_date):
     @return: None, the function prints its results
     '''
     pols = ('NO', 'PM10', 'PM25')
-    out = []
-    # out = [treat_data(get_live_data_from_api(loc, pol)) for pol in pols]
-    for pol in pols:
-        out.append(treat_data(get_live_data_from_api(
-            loc, pol, start_date)))
+    # The three pollutants are fetched concurrently and aligned hour by hour
+    snapshot = live_snapshot([loc], pols, start_date)
 
-    print(out)
-    print(len(out))
     print('\n{}Date & Time{}| NO | PM10 | PM25'.format(5*' ', 5*' '))
-    for hour in range(len(out[0])):
-        print(out[0][hour][0], ' ', out[0][hour][1], ' ',
-              out[1][hour][1], '  ', out[2][hour][1])
+    for hour, row in zip(time_labels(snapshot['hours']), snapshot['values'][0].T):
+        print(hour, ' ', *('N/A' if np.isnan(val) else val for val in row), sep='  ')
 
     print(f'\nLOCATION: {loc}\n')
 
@@ -118,22 +774,18 @@ def trace_data(data, *args, **kwargs):
     '''
     Traces a graph from data imported from the LondonAir API using Matplotlib 
 
-    @param: data --> input data from the api. It is for one specific pollutant and location
+    @param: data --> samples (see decode_payload) or treated data from the api. It is for one specific pollutant and location
 
     @return: Success/Failure depending on whether or not the graph was traced
     '''
-    arr = []
-    for line in data:
-        if line[1] != 'N/A':
-            arr.append((float(line[1]), line[0]))
-    if len(arr) == 0:
+    samples = as_samples(data)
+    samples = samples[~np.isnan(samples['value'])]
+    if len(samples) == 0:
         print('\nThere is insufficient data in your selected parameters to complete this function. Try NO at Marylebone Road station if problem persists.\n')
         return 'Failure'
-    print(len(arr))
-    x = [datetime.datetime.strptime(d[1], '%Y-%m-%d %H:%M:%S') for d in arr]
-    y = [d[0] for d in arr]
+    print(len(samples))
     plt.style.use('dark_background')
-    plt.plot(x, y, marker='.', linestyle='dashed', markersize=12)
+    plt.plot(samples['time'], samples['value'], marker='.', linestyle='dashed', markersize=12)
     plt.xlabel('Date')
     plt.ylabel('Value')
     plt.show()
@@ -142,19 +794,26 @@ def trace_data(data, *args, **kwargs):
 
 
 def average_pol(data, start_date, *args, **kwargs):
-    """Your documentation goes here"""
-    print(data[11])
-    arr = []
-    for line in data:
-        if line[1] != 'N/A':
-            arr.append(float(line[1]), line[0])
+    '''
+    Prints the average value of a pollutant over the chosen time frame, ignoring missing data points.
+
+    @param: data --> samples (see decode_payload) or treated data for one pollutant at one location
+    @param: start_date --> start of the time frame (today or the start of the week)
+
+    @return: Success/Failure depending on whether there was data to average
+    '''
+    values = as_samples(data)['value']
+    values = values[~np.isnan(values)]
 
-    if arr is None:
+    if len(values) == 0:
         print('\nThere is insufficient data in your selected parameters to complete this function. Try NO at Marylebone Road station if problem persists.\n')
         return 'Failure'
 
-    time_span = 'since midnight' if start_date is datetime.date.today(
+    time_span = 'since midnight' if start_date == datetime.date.today(
     ) else 'over the course of this week'
     print(
-        f'Average value for your chosen location and pollution {time_span} is {sum(arr) / len(arr)}')
+        f'Average value for your chosen location and pollution {time_span} is {values.mean()}')
     return 'Success'
+
+
+instrument_module(__name__)
@@ -1,166 +1,1097 @@
+import copy
+import functools
+import hashlib
+import itertools
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instrumentation import instrument_module, merge_counters, record, worker_call
+from utils import RunningStats
+
+
 indices = {'date': 0,
            'time': 1,
            'no': 2,
            'pm10': 3,
            'pm25': 4}  # Dictionary to keep track of columns within the data file
 
+MISSING = 'No data'  # Marker used in the station files for hours without a reading
+
+_versions = itertools.count()  # Source of StationData versions, see StationData.touch()
+
+
+class DateIndex:
+    '''
+    Date and hour lookups over the sorted datetime64[h] index of a station.
+    Whole days are found in O(1) through a dictionary of row ranges, other timestamps and spans 
+    in O(log n) with a binary search.
+
+    @param: dates --> sorted datetime64[h] array
+    '''
+
+    def __init__(self, dates):
+        self.dates = dates
+        days = dates.astype('datetime64[D]').astype(np.int64)
+        offsets = _group_offsets(days)
+        self.days = {int(days[start]): (int(start), int(stop))
+                     for start, stop in zip(offsets[:-1], offsets[1:])}
+
+    def day(self, date):
+        '''
+        Rows of a given day (YYYY-MM-DD string or date), empty when the day is not in the data.
+        '''
+        start, stop = self.days.get(int(np.datetime64(date, 'D').astype(np.int64)), (0, 0))
+        return slice(start, stop)
+
+    def between(self, start, end):
+        '''
+        Rows whose hour starts within [start, end).
+
+        @param: start, end --> dates or timestamps (eg: '2021-01-04' or '2021-01-04T13')
+        '''
+        low, high = np.searchsorted(self.dates, [np.datetime64(start, 'h'), np.datetime64(end, 'h')])
+        return slice(int(low), int(max(low, high)))
+
+    def row(self, timestamp):
+        '''
+        Row of the hour starting at the given timestamp, or None if there is no such row.
+        '''
+        timestamp = np.datetime64(timestamp, 'h')
+        row = int(np.searchsorted(self.dates, timestamp))
+        if row < len(self.dates) and self.dates[row] == timestamp:
+            return row
+        return None
+
+
+class StationData:
+    '''
+    Columnar view of a station file, parsed once into typed NumPy arrays.
+    Rows are kept in chronological order and indexed by date when the data is loaded (see DateIndex).
+
+    Each pollutant is stored as a contiguous float64 column in which missing readings are NaN.
+    The `dates` column holds the start of each measured hour as datetime64[h]: the row stamped 
+    `2021-01-01,01:00:00` in the file covers 00:00 to 01:00 and is therefore indexed at 2021-01-01T00.
+
+    @param: dates --> datetime64[h] array with one entry per row
+    @param: no, pm10, pm25 --> float64 arrays of the same length as dates
+
+    Every instance gets a unique `version`. Results cached by ReportCache are keyed on it, so a filled 
+    copy (see fill_missing_data) never reuses the reports of the data it was made from.
+    '''
+
+    pollutants = ('no', 'pm10', 'pm25')
+
+    def __init__(self, dates, no, pm10, pm25, monitoring_station=None):
+        dates = np.asarray(dates, dtype='datetime64[h]')
+        order = np.argsort(dates, kind='stable') if (dates[1:] < dates[:-1]).any() else slice(None)
+        self.dates = np.ascontiguousarray(dates[order])
+        self.no = np.ascontiguousarray(np.asarray(no, dtype=np.float64)[order])
+        self.pm10 = np.ascontiguousarray(np.asarray(pm10, dtype=np.float64)[order])
+        self.pm25 = np.ascontiguousarray(np.asarray(pm25, dtype=np.float64)[order])
+        self.index = DateIndex(self.dates)
+        self.monitoring_station = monitoring_station
+        self._buckets = {}  # Bucket layouts, computed on first use by buckets()
+        self._regular = None
+        self.version = next(_versions)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __repr__(self):
+        return f'StationData({self.monitoring_station!r}, {len(self)} rows)'
+
+    def __getitem__(self, rows):
+        '''
+        Returns the StationData for a slice of rows. The columns are views of this instance's columns.
+        '''
+        if not isinstance(rows, slice):
+            raise TypeError('StationData can only be sliced')
+        return StationData(self.dates[rows], self.no[rows], self.pm10[rows], self.pm25[rows], self.monitoring_station)
+
+    @classmethod
+    def concatenate(cls, parts, monitoring_station=None):
+        '''
+        Joins several StationData (eg: chunks of the same file) into one.
+        '''
+        parts = list(parts)
+        if monitoring_station is None and parts:
+            monitoring_station = parts[0].monitoring_station
+        columns = [np.concatenate([getattr(part, name) for part in parts] or [np.empty(0)])
+                   for name in ('dates',) + cls.pollutants]
+        return cls(*columns, monitoring_station=monitoring_station)
+
+    @classmethod
+    def from_lines(cls, lines, monitoring_station=None, header=True):
+        '''
+        Parses the lines of a station file in a single pass.
+
+        @param: lines --> list of strings as returned by f.read().split('\\n')
+        @param: header --> whether the first line is the csv header
+
+        @return: StationData with one row per non-empty data line
+        '''
+        rows = [line.rstrip('\n').split(',') for line in lines[1 if header else 0:] if line.strip()]
+        if not rows:
+            empty = np.empty(0)
+            return cls(empty.astype('datetime64[h]'), empty, empty, empty, monitoring_station)
+        columns = list(zip(*rows))
+
+        days = np.array(columns[indices['date']], dtype='datetime64[D]')
+        # Hours are stamped 01:00 to 24:00 at the end of the period they cover.
+        hours = np.array([int(t[:2]) - 1 for t in columns[indices['time']]])
+        dates = days.astype('datetime64[h]') + hours
+
+        return cls(dates, *(_parse_column(columns[indices[pol]]) for pol in cls.pollutants),
+                   monitoring_station=monitoring_station)
+
+    @classmethod
+    def from_csv(cls, path, monitoring_station=None):
+        '''
+        Reads and parses a station csv file.
+
+        @param: path --> path to the csv file
+
+        @return: StationData for the whole file
+        '''
+        return cls.concatenate(read_station_chunks(path, monitoring_station=monitoring_station), monitoring_station)
+
+    def column(self, pollutant):
+        '''
+        Returns the float64 column for the chosen pollutant (no copy is made).
+        '''
+        if pollutant not in self.pollutants:
+            raise ValueError(f'Unknown pollutant {pollutant!r}')
+        return getattr(self, pollutant)
+
+    def touch(self):
+        '''
+        Marks the data as modified in place: reports cached for its previous version are no longer used.
+        '''
+        self.version = next(_versions)
+
+    def is_regular(self):
+        '''
+        True when the rows are whole days of consecutive hours starting at midnight, 
+        ie: when day_hour_view() lines up with the calendar.
+        '''
+        if self._regular is None:
+            dates = self.dates
+            self._regular = bool(len(dates) % 24 == 0 and (len(dates) == 0 or (
+                dates[0] == dates[0].astype('datetime64[D]') and (np.diff(dates) == np.timedelta64(1, 'h')).all())))
+        return self._regular
+
+    def buckets(self, by):
+        '''
+        Groups the rows by their actual date and time, see bucket_keys() for the possible groupings.
+        The layout only depends on the dates so it is computed once and shared by every pollutant.
+
+        @param: by --> bucketing rule
+
+        @return: labels --> label of each bucket, in increasing order
+        @return: offsets --> start of each bucket within the (reordered) rows, followed by the number of rows
+        @return: order --> row permutation making each bucket contiguous, None when the rows already are
+        '''
+        key = by if isinstance(by, str) else ('period', np.timedelta64(by, 'h'))
+        if key not in self._buckets:
+            keys, labels = bucket_keys(self.dates, by)
+            order = None
+            if len(keys) and (keys[1:] < keys[:-1]).any():
+                order = np.argsort(keys, kind='stable')
+                keys = keys[order]
+            offsets = _group_offsets(keys)
+            self._buckets[key] = (labels(keys[offsets[:-1]]), offsets, order)
+        return self._buckets[key]
+
+    def with_column(self, pollutant, values):
+        '''
+        Returns a new StationData where only the chosen pollutant column is replaced. 
+        The other columns are shared with this instance, not copied.
+        '''
+        columns = {pol: self.column(pol) for pol in self.pollutants}
+        columns[pollutant] = values
+        return StationData(self.dates, monitoring_station=self.monitoring_station, **columns)
+
+
+def read_station_chunks(path, chunk_size=24*366, monitoring_station=None):
+    '''
+    Generator reading a station csv file in fixed-size chunks of rows, so that only one chunk
+    of text is held in memory at a time, however long the file is.
+
+    @param: path --> path to the csv file
+    @param: chunk_size --> number of rows in each chunk (one leap year of hours by default)
+
+    @return: yields a StationData for each chunk, in file order
+    '''
+    with open(path) as f:
+        next(f, None)  # Header
+        buffer = []
+        for line in f:
+            buffer.append(line)
+            if len(buffer) == chunk_size:
+                record(rows=len(buffer))
+                yield StationData.from_lines(buffer, monitoring_station, header=False)
+                buffer = []
+        if buffer:
+            record(rows=len(buffer))
+            yield StationData.from_lines(buffer, monitoring_station, header=False)
+        record(bytes_read=f.buffer.tell())
+
+
+CACHE_VERSION = 1  # Bump whenever the layout of the binary cache changes
+
+
+def cache_directory(path):
+    '''
+    Sidecar directory holding the binary cache of a station csv file (eg: data/.Pollution-London Harlington.csv.cache).
+    '''
+    head, tail = os.path.split(path)
+    return os.path.join(head, f'.{tail}.cache')
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {'version': CACHE_VERSION, 'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_cache_meta(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache_meta(directory, meta):
+    tmp = os.path.join(directory, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(directory, 'meta.json'))
+
+
+def write_station_cache(data, path):
+    '''
+    Saves the parsed columns of a station csv file as raw .npy files in its cache directory.
+    meta.json is removed first and written last, so a partially written cache is never considered valid.
+    Each column is written to a temporary file then renamed over the old one: columns memory mapped by an
+    earlier load_station keep their (old) file instead of seeing it truncated under them.
+
+    @param: data --> StationData parsed from the file
+    @param: path --> path to the csv file
+    '''
+    directory = cache_directory(path)
+    os.makedirs(directory, exist_ok=True)
+    meta = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta):
+        os.remove(meta)
+    for name in ('dates',) + StationData.pollutants:
+        column = os.path.join(directory, f'{name}.npy')
+        with open(column + '.tmp', 'wb') as f:
+            np.save(f, getattr(data, name))
+        os.replace(column + '.tmp', column)
+    _write_cache_meta(directory, dict(_file_signature(path), sha256=_file_hash(path)))
+
+
+def load_station(path, monitoring_station=None, cache=True):
+    '''
+    Loads a station csv file, going through its binary cache when possible.
+
+    The cache is valid when the file's path, size and modification time match the ones recorded with it. 
+    If only the modification time differs, the content hash decides (the cache is kept for a touched but 
+    unchanged file). Otherwise the file is parsed again and the cache rebuilt. 
+    Columns of a valid cache are memory mapped, so a warm load does not parse any text.
+
+    @param: path --> path to the csv file
+    @param: cache --> set to False to always parse the csv file
+
+    @return: StationData
+    '''
+    if not cache:
+        return StationData.from_csv(path, monitoring_station)
+
+    directory = cache_directory(path)
+    signature = _file_signature(path)
+    meta = _read_cache_meta(directory)
+    if meta is not None and all(meta.get(key) == signature[key] for key in ('version', 'path', 'size')):
+        valid = meta['mtime'] == signature['mtime']
+        if not valid and meta.get('sha256') == _file_hash(path):
+            valid = True
+            try:
+                _write_cache_meta(directory, dict(meta, mtime=signature['mtime']))
+            except OSError:
+                pass
+        if valid:
+            try:
+                columns = [np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                           for name in ('dates',) + StationData.pollutants]
+                return StationData(*columns, monitoring_station=monitoring_station)
+            except (OSError, ValueError):
+                pass
+
+    data = StationData.from_csv(path, monitoring_station)
+    try:
+        write_station_cache(data, path)
+    except OSError:
+        pass  # A read-only data directory only means the next load parses the file again
+    return data
+
+
+def bucket_keys(dates, by):
+    '''
+    Computes the bucket of each hourly timestamp from the calendar rather than from its row number, 
+    so leap years, partial years and gaps in the rows are handled.
+
+    @param: dates --> datetime64[h] array
+    @param: by --> 'hour' (hour of the day, 0 to 23), 'day', 'week' (ISO weeks, starting on Monday), 
+                   'month', 'year', or a period such as np.timedelta64(6, 'h') or datetime.timedelta(days=2).
+                   Periods are aligned on 1970-01-01T00.
+
+    @return: keys --> integer key of each timestamp, increasing with time except for 'hour'
+    @return: labels --> function mapping keys to bucket labels (datetime64 of the bucket start, or the hour)
+    '''
+    hours = dates.astype('datetime64[h]').astype(np.int64)
+    if by == 'hour':
+        return hours % 24, lambda keys: keys
+    if by in ('day', 'month', 'year'):
+        unit = by[0].upper()
+        return dates.astype(f'datetime64[{unit}]').astype(np.int64), lambda keys: keys.astype(f'datetime64[{unit}]')
+    if by == 'week':
+        # 1970-01-01 was a Thursday: shifting by 3 days makes every key start on a Monday.
+        return (hours // 24 + 3) // 7, lambda keys: (keys * 7 - 3).astype('datetime64[D]')
+    if isinstance(by, str):
+        raise ValueError(f'Unknown aggregation {by!r}')
+
+    period = int(np.timedelta64(by, 'h').astype(np.int64))
+    if period <= 0:
+        raise ValueError('The aggregation period must be at least one hour')
+    return hours // period, lambda keys: (keys * period).astype('datetime64[h]')
+
+
+def _parse_column(values):
+    '''
+    Converts a column of strings to float64, turning missing data markers into NaN.
+    '''
+    arr = np.array(values)
+    arr[arr == MISSING] = 'nan'
+    return arr.astype(np.float64)
+
+
+def as_station_data(data, monitoring_station=None):
+    '''
+    Adapter accepting either a StationData or the raw list of lines of a station file.
+
+    @param: data --> StationData, or csv lines as read by f.read().split('\\n')
+
+    @return: StationData
+    '''
+    if isinstance(data, StationData):
+        return data
+    return StationData.from_lines(data, monitoring_station)
+
+
+STATISTICS = ('mean', 'median', 'min', 'max')  # Statistics computed by aggregate() unless told otherwise
+
+_QUANTILES = {'median': 0.5, 'min': 0.0, 'max': 1.0}
+
+
+def day_hour_view(values):
+    '''
+    Reshapes an hourly column into a (days, 24) view without copying it.
+    Hours of an incomplete trailing day are left out of the view.
+
+    @param: values --> 1D array of hourly values starting at midnight
+
+    @return: 2D view where row d holds the 24 hours of day d
+    '''
+    days = len(values) // 24
+    return values[:days*24].reshape(days, 24)
+
+
+def _quantile_rows(ordered, count, q):
+    '''
+    Linear interpolation quantile (same method as np.percentile) of each row of a sorted array
+    whose NaNs have been pushed to the end. Rows without valid samples give NaN.
+    '''
+    position = q * (count - 1)
+    low = np.floor(position).astype(np.intp).clip(0)
+    high = np.ceil(position).astype(np.intp).clip(0)
+    rows = np.arange(len(ordered))
+    below, above = ordered[rows, low], ordered[rows, high]
+    out = below + (above - below) * (position - low)
+    out[count == 0] = np.nan
+    return out
+
+
+def _quantile_columns(ordered, q):
+    '''
+    Same as _quantile_rows when no row has missing values: every row has the same ranks, 
+    so the quantile is read from (at most) two columns instead of gathered element by element.
+    '''
+    size = ordered.shape[-1]
+    if size == 0:
+        return np.full(len(ordered), np.nan)
+    position = q * (size - 1)
+    low, high = int(np.floor(position)), int(np.ceil(position))
+    if low == high:
+        return ordered[:, low].copy()
+    below, above = ordered[:, low], ordered[:, high]
+    return below + (above - below) * (position - low)
+
+
+def _reduce(view, axis, statistics, percentiles):
+    '''
+    Applies the NaN-aware reductions along one axis of a 2D array.
+    Order statistics (median, percentiles, min and max) all come from a single sort of the buckets.
+    '''
+    rows = view if axis in (-1, view.ndim - 1) else np.moveaxis(view, axis, -1)
+    missing = np.isnan(rows)
+    complete = not missing.any()
+    count = np.full(rows.shape[:-1], rows.shape[-1]) if complete else rows.shape[-1] - np.count_nonzero(missing, axis=-1)
+    out = {'count': count}
+
+    if 'mean' in statistics:
+        total = rows.sum(axis=-1) if complete else np.where(missing, 0, rows).sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['mean'] = total / count
+
+    ordered_stats = [stat for stat in statistics if stat in _QUANTILES]
+    if ordered_stats or len(percentiles):
+        ordered = np.sort(rows, axis=-1)  # NaNs are sorted to the end of each row
+        quantile = (lambda q: _quantile_columns(ordered, q)) if complete else (lambda q: _quantile_rows(ordered, count, q))
+        for stat in ordered_stats:
+            out[stat] = quantile(_QUANTILES[stat])
+        for p in percentiles:
+            out[f'p{p:g}'] = quantile(p / 100)
+    return out
+
+
+def _group_offsets(keys):
+    '''
+    Start offsets of the runs of equal consecutive keys, followed by len(keys).
+
+    @param: keys --> 1D array where rows of the same bucket are next to each other
+    '''
+    if len(keys) == 0:
+        return np.zeros(1, dtype=np.intp)
+    return np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1, len(keys)]
+
+
+def _reduce_segments(values, offsets, statistics, percentiles):
+    '''
+    Segmented reduction: values[offsets[i]:offsets[i+1]] forms bucket i.
+    Counts and sums use np.add.reduceat; order statistics scatter the segments into a NaN-padded 
+    (buckets, longest segment) matrix so they are computed by a single sort of its rows.
+
+    @param: values --> 1D float array, sorted so that each bucket is contiguous
+    @param: offsets --> start index of each bucket, followed by the end of the last bucket
+    '''
+    offsets = np.asarray(offsets, dtype=np.intp)
+    lengths = np.diff(offsets)
+    if len(lengths) == 0:
+        return _reduce(np.empty((0, 1)), 1, statistics, percentiles)
+    ordered_stats = [stat for stat in statistics if stat in _QUANTILES]
+    if ordered_stats or len(percentiles):
+        padded = np.full((len(lengths), lengths.max()), np.nan)
+        bucket = np.repeat(np.arange(len(lengths)), lengths)
+        position = np.arange(offsets[-1] - offsets[0]) - np.repeat(offsets[:-1] - offsets[0], lengths)
+        padded[bucket, position] = values[offsets[0]:offsets[-1]]
+        return _reduce(padded, 1, statistics, percentiles)
+
+    segment = values[offsets[0]:offsets[-1]]
+    missing = np.isnan(segment)
+    starts = offsets[:-1] - offsets[0]
+    count = lengths - np.add.reduceat(missing, starts)
+    out = {'count': count}
+    if 'mean' in statistics:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['mean'] = np.add.reduceat(np.where(missing, 0, segment), starts) / count
+    return out
+
+
+def aggregate(data, pollutant, by='day', statistics=STATISTICS, percentiles=()):
+    '''
+    Vectorised aggregation engine used by the reporting functions.
+    Each statistic is computed for every bucket at once with NaN-aware NumPy reductions, so missing values 
+    are skipped rather than propagated.
+    Rows are bucketed by their dates (see bucket_keys), and the zero-copy (day, hour) view is used 
+    whenever the data is made of whole, gapless days.
+
+    @param: data --> StationData (or csv lines) with hourly rows
+    @param: pollutant --> column to aggregate
+    @param: by --> 'hour', 'day', 'week', 'month', 'year' or a period (see bucket_keys)
+    @param: statistics --> any of 'mean', 'median', 'min' and 'max'
+    @param: percentiles --> percentiles to add to the output, stored under keys such as 'p95'
+
+    @return: dictionary mapping each statistic and 'count' (valid samples in each bucket) to a NumPy array,
+             and 'bucket' to the label of each bucket
+    '''
+    data = as_station_data(data)
+    values = data.column(pollutant)
+    labels, offsets, order = data.buckets(by)
+    record(rows=len(data))
+
+    if by in ('day', 'hour') and data.is_regular():
+        out = _reduce(day_hour_view(values), 1 if by == 'day' else 0, statistics, percentiles)
+        if by == 'hour':
+            labels = np.arange(24)  # The view always has 24 hour columns, even with no rows at all
+    else:
+        out = _reduce_segments(values if order is None else values[order], offsets, statistics, percentiles)
+    out['bucket'] = labels
+    return out
+
+
+def stream_aggregate(chunks, pollutant, by='day', statistics=STATISTICS, percentiles=()):
+    '''
+    Streaming version of aggregate() folding chunks of rows one at a time, so memory stays bounded 
+    by the chunk size rather than by the length of the data.
+
+    For calendar buckets the rows of the last, possibly incomplete, bucket of each chunk are carried over 
+    to the next chunk, which keeps every statistic exact. Buckets by hour of the day span the whole data, 
+    so they are folded into RunningStats accumulators (see utils.py): only 'mean', 'min' and 'max' 
+    can be streamed that way.
+
+    @param: chunks --> iterable of StationData in chronological order (eg: read_station_chunks(path))
+    @param: pollutant, by, statistics, percentiles --> same as aggregate()
+
+    @return: same dictionary as aggregate() would return for the whole data
+    '''
+    if by == 'hour':
+        return _stream_hourly(chunks, pollutant, statistics, percentiles)
+
+    parts = []
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = StationData.concatenate([carry, chunk])
+        _, offsets, _ = chunk.buckets(by)
+        if len(offsets) < 2:
+            continue
+        last = offsets[-2]
+        if last:
+            parts.append(aggregate(chunk[:last], pollutant, by, statistics, percentiles))
+        carry = chunk[last:]
+    if carry is not None:
+        parts.append(aggregate(carry, pollutant, by, statistics, percentiles))
+    if not parts:
+        return aggregate(StationData.concatenate([]), pollutant, by, statistics, percentiles)
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+
+def _stream_hourly(chunks, pollutant, statistics, percentiles):
+    '''
+    Folds the hour of the day statistics of each chunk into running accumulators (see stream_aggregate).
+    '''
+    if len(percentiles) or 'median' in statistics:
+        raise ValueError('Medians and percentiles by hour of the day cannot be streamed')
+    hours = [RunningStats(value_counts=False) for _ in range(24)]
+    for chunk in chunks:
+        labels, offsets, order = chunk.buckets('hour')
+        values = chunk.column(pollutant)
+        values = values if order is None else values[order]
+        for hour, start, stop in zip(labels, offsets[:-1], offsets[1:]):
+            hours[hour].update(values[start:stop])
+
+    out = {'count': np.array([stats.count for stats in hours], dtype=np.int64)}
+    accumulators = {
+        'mean': [stats.mean if stats.count else np.nan for stats in hours],
+        'min': [np.nan if stats.minimum is None else stats.minimum for stats in hours],
+        'max': [np.nan if stats.maximum is None else stats.maximum for stats in hours]}
+    for stat in statistics:
+        out[stat] = np.array(accumulators[stat])
+    out['bucket'] = np.arange(24)
+    return out
+
+
+def _station_chunks(source, monitoring_station):
+    '''
+    Accepts either the path of a station file or an iterable of StationData chunks.
+    '''
+    if isinstance(source, str):
+        return read_station_chunks(source, monitoring_station=monitoring_station)
+    return source
+
+
+def _complete_days(daily):
+    '''
+    Daily means up to the first day with missing hours, as expected by daily_average.
+    '''
+    complete = daily['count'] == 24
+    if complete.all():
+        return daily['mean'].tolist()
+
+    print('There are missing values in this data, run th Fill Missing Data function first. \nHere are the averages up until the point of the error')
+    return daily['mean'][:np.argmin(complete)].tolist()
+
+
+def stream_daily_average(source, monitoring_station, pollutant):
+    '''
+    Streaming version of daily_average, reading the data chunk by chunk.
+
+    @param: source --> path to a station csv file, or an iterable of StationData chunks
+    @param: pollutant --> the user's chosen pollutant. Indicates which column to read data from
+
+    @return: same list as daily_average
+    '''
+    return _complete_days(stream_aggregate(_station_chunks(source, monitoring_station), pollutant, 'day', ('mean',)))
+
+
+def stream_hourly_average(source, monitoring_station, pollutant):
+    '''
+    Streaming version of hourly_average, reading the data chunk by chunk.
+
+    @param: source --> path to a station csv file, or an iterable of StationData chunks
+    @param: pollutant --> the user's chosen pollutant. Indicates which column to read data from
+
+    @return: same list as hourly_average
+    '''
+    return stream_aggregate(_station_chunks(source, monitoring_station), pollutant, 'hour', ('mean',))['mean'].tolist()
+
+
+def stream_monthly_average(source, monitoring_station, pollutant):
+    '''
+    Streaming version of monthly_average, reading the data chunk by chunk.
+
+    @param: source --> path to a station csv file, or an iterable of StationData chunks
+    @param: pollutant --> the user's chosen pollutant. Indicates which column to read data from
+
+    @return: same list as monthly_average
+    '''
+    return stream_aggregate(_station_chunks(source, monitoring_station), pollutant, 'month', ('mean',))['mean'].tolist()
+
 
 def daily_average(data, monitoring_station, pollutant):
     '''
     Returns the average for each day of the year
 
-    @param: data --> csv file with data to treat
+    @param: data --> StationData (or csv lines) with data to treat
     @param: pollutant --> the user's chosen pollutant. Indicates which column to read data from
 
-    @return: averages --> list of 365 values containing the average value for each day's data
+    @return: averages --> list with the average value for each day's data (365 values for a full year)
     '''
-    averages = []
-    # Uses dictionary to identify the index to use within the split line of data
-    ind = indices[pollutant]
-    try:
-        for day_number in range(365):
-            total = 0
-            for hour in range(1, 25):
-                # Finds the line of data for the concerned day and hour.
-                hour_line = data[(day_number*24)+hour].split(',')
-                total += float(hour_line[ind])
-            averages.append(total / 24)
-    except:
-        print('There are missing values in this data, run th Fill Missing Data function first. \nHere are the averages up until the point of the error')
-    return averages
+    return _complete_days(aggregate(as_station_data(data, monitoring_station), pollutant, 'day', ('mean',)))
 
 
 def daily_median(data, monitoring_station, pollutant):
     '''
     Returns the median for each day of the year
 
-    @param: data --> csv file with data to treat
+    @param: data --> StationData (or csv lines) with data to treat
     @param: pollutant --> the user's chosen pollutant. Indicates which column to read data from
 
-    @param: medians --> list of 365 values containing the median value for each day's data
+    @return: medians --> list with the median value for each day's data (365 values for a full year)
     '''
-    medians = []
-    ind = indices[pollutant]
-    for day_number in range(365):
-
-        values = []
-        for hour in range(1, 25):
-            hour_line = data[day_number*24 + hour].split(',')
-            values.append(float(hour_line[ind]))
-        values.sort()
-        # if len(values) % 2 == 0:
-        #     medians.append(
-        #         (values[len(values)//2]+values[len(values)//2 + 1])/2)
-        # else:
-        #     medians.append(values[int(len(values)/2)])
-        medians.append((values[12]+values[13]) / 2)
-    return medians
+    return aggregate(as_station_data(data, monitoring_station), pollutant, 'day', ('median',))['median'].tolist()
 
 
 def hourly_average(data, monitoring_station, pollutant):
     '''
     Hourly average for a given pollutant across the whole year. 
 
-    @param: data --> csv file with data to treat
+    @param: data --> StationData (or csv lines) with data to treat
     @param: pollutant --> the user's chosen pollutant. Indicates which column to read data from
 
     @return: avg --> list of 24 values each representing the average for the according hour. 
     '''
-    ind = indices[pollutant]
-    avg = [0 for _ in range(24)]
-
-    for day_number in range(365):
-        for hour_number in range(1, 25):
-            value = data[day_number*24 + hour_number].split(',')[ind]
-            print('VALUE = ' + value)
-            avg[hour_number-1] += float(value)
-
-    for value in range(24):
-        avg[value] /= 365
-
-    return avg
+    return aggregate(as_station_data(data, monitoring_station), pollutant, 'hour', ('mean',))['mean'].tolist()
 
 
 def monthly_average(data, monitoring_station, pollutant):
     '''
-    Reads a year of data and returns an average for each month. 
+    Reads the data and returns an average for each calendar month it covers. 
 
-    @param: data --> csv file with data to treat
+    @param: data --> StationData (or csv lines) with data to treat
     @param: pollutant --> the user's chosen pollutant. Indicates which column to read data from
 
-    @return: 12 values corresponding to the monthly averages
+    @return: monthly averages, in chronological order (12 values for a full year)
     '''
+    return aggregate(as_station_data(data, monitoring_station), pollutant, 'month', ('mean',))['mean'].tolist()
 
-    months = [31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365]
-    # List with the number of days elapsed before the end of each month.
-    # This allows us to which month each day falls into
 
-    no_of_hours = [0 for _ in range(12)]
-    # To keep track of the number of hours in each month as we iterate
+def peak_hour_date(data, date, monitoring_station, pollutant):
+    '''
+    Returns the peak value of the chosen pollutant in a given day.
 
-    avgs = [0 for _ in range(12)]
-    ind = indices[pollutant]
+    @param: data --> StationData (or csv lines) to be used as data
+    @param: date --> the date chosen by the user (YYYY-MM-DD)
+    @param: pollutant --> the pollutant chosen by the user
 
-    for day_number in range(1, 365):
-        for hour in range(1, 25):
-            val = float(data[day_number*24+hour].split(',')[ind])
+    @return --> Peak hour and its value 
+    '''
+    data = as_station_data(data, monitoring_station)
+    rows = data.index.day(date)
+    if rows.start == rows.stop:
+        raise ValueError(f'{date} is not covered by the data')
 
-            avgs[12-len(months)] += val
-            no_of_hours[12-len(months)] += 1
-            if day_number == months[0] and hour == 24:
-                months.pop(0)
+    values = data.column(pollutant)[rows]
+    if not (values > 0).any():
+        return '0, 0'
+    peak = np.nanargmax(values)
+    # Hours are displayed the way the station files stamp them, from 1:00 to 24:00
+    hour = (data.dates[rows][peak] - np.datetime64(date, 'D')).astype(np.int64) + 1
+    return f'{hour}:00, {values[peak]}'
 
-    for i in range(12):
-        avgs[i] = avgs[i] / no_of_hours[i]
-    return avgs
 
+def peak_hour_range(data, start, end, monitoring_station, pollutant):
+    '''
+    Returns the hour with the highest value of the chosen pollutant over a span of time.
 
-def peak_hour_date(data, date, monitoring_station, pollutant):
+    @param: data --> StationData (or csv lines) to be used as data
+    @param: start, end --> span of time [start, end), as dates or timestamps (eg: '2021-01-04', '2021-01-11')
+    @param: pollutant --> the pollutant chosen by the user
+
+    @return: (start of the peak hour as datetime64[h], value), or None if the span has no valid data
     '''
-    Returns the peak value of the chosen pollutant in a given day.
+    data = as_station_data(data, monitoring_station)
+    top = top_hours(data, start, end, 1, monitoring_station, pollutant)
+    return top[0] if top else None
+
+
+def top_hours(data, start, end, n, monitoring_station, pollutant):
+    '''
+    Returns the n hours with the highest values of the chosen pollutant over a span of time.
 
-    @param: data --> csv file to be used as data
-    @param: date --> the date chosen by the user
+    @param: data --> StationData (or csv lines) to be used as data
+    @param: start, end --> span of time [start, end), as dates or timestamps
+    @param: n --> number of hours to return
     @param: pollutant --> the pollutant chosen by the user
 
-    @return --> Peak hour and its value 
+    @return: list of (start of the hour as datetime64[h], value), highest value first. Missing hours are skipped.
     '''
-    ind = indices[pollutant]
+    if n <= 0:
+        return []
+    data = as_station_data(data, monitoring_station)
+    rows = data.index.between(start, end)
+    values = data.column(pollutant)[rows]
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) > n:
+        valid = valid[np.argpartition(values[valid], -n)[-n:]]
+    valid = valid[np.argsort(-values[valid], kind='stable')]
+    dates = data.dates[rows]
+    return [(dates[i], float(values[i])) for i in valid]
+
+
+def value_at(data, timestamp, monitoring_station, pollutant):
+    '''
+    Returns the value of the chosen pollutant for the hour starting at the given timestamp.
 
-    month, day = date.split('-')[1:]
-    max_val = 0
-    max_hour = 0
-    months = [31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365]
-    for i in range(1, 25):
-        val = data[months[(month-1)*24+day+i]][ind]
-        if val > max_val:
-            max_val = val
-            max_hour = f'{i}:00'
+    @param: data --> StationData (or csv lines) to be used as data
+    @param: timestamp --> start of the hour (eg: '2021-01-04T13' is stamped 2021-01-04,14:00:00 in the files)
+    @param: pollutant --> the pollutant chosen by the user
 
-    return f'{max_hour}, {max_val}'
+    @return: value (NaN if it is missing), or None if the hour is not in the data
+    '''
+    data = as_station_data(data, monitoring_station)
+    row = data.index.row(timestamp)
+    return None if row is None else float(data.column(pollutant)[row])
 
 
 def count_missing_data(data,  monitoring_station, pollutant):
     '''
     Counts the instances of missing data in a file of data
     '''
+    values = as_station_data(data, monitoring_station).column(pollutant)
+    return int(np.count_nonzero(np.isnan(values)))
+
+
+def missing_counts(data):
+    '''
+    Counts the missing values of every pollutant column at once.
+
+    @param: data --> StationData (or csv lines)
+
+    @return: dictionary mapping each pollutant to its number of missing values
+    '''
+    data = as_station_data(data)
+    return {pol: int(np.count_nonzero(np.isnan(data.column(pol)))) for pol in data.pollutants}
+
+
+def masked_column(data, pollutant):
+    '''
+    Returns the pollutant column as a masked array hiding its missing values. The values are not copied.
+    '''
+    values = as_station_data(data).column(pollutant)
+    return np.ma.masked_array(values, mask=np.isnan(values))
+
+
+def missing_runs(data, pollutant):
+    '''
+    Gap report: every run of consecutive missing hours, found in one pass over an hourly mask.
+    Hours with no row at all in the data count as missing, just like 'No data' readings.
+
+    @param: data --> StationData (or csv lines)
+    @param: pollutant --> column to check
+
+    @return: starts --> datetime64[h] start of each run of missing hours
+    @return: lengths --> number of hours in each run
+    '''
+    data = as_station_data(data)
+    if len(data) == 0:
+        return data.dates[:0], np.zeros(0, dtype=np.int64)
+    offsets = (data.dates - data.dates[0]).astype(np.int64)
+    missing = np.ones(offsets[-1] + 3, dtype=np.int8)
+    missing[[0, -1]] = 0  # Padding so that every run has a start and an end
+    missing[offsets + 1] = np.isnan(data.column(pollutant))
+    edges = np.diff(missing)
+    starts = np.flatnonzero(edges == 1)
+    lengths = np.flatnonzero(edges == -1) - starts
+    return data.dates[0] + starts, lengths
+
+
+FILL_STRATEGIES = ('constant', 'ffill', 'linear', 'hourly_mean')
+
+
+def fill_column(data, pollutant, strategy='constant', value=None):
+    '''
+    Fills the missing values of one column.
+
+    @param: data --> StationData (or csv lines)
+    @param: pollutant --> column to fill
+    @param: strategy --> 'constant' (use value), 'ffill' (last valid value), 'linear' (interpolation in time 
+                         between the surrounding valid values) or 'hourly_mean' (mean of the same hour of the day)
+    @param: value --> replacement used by the 'constant' strategy
+
+    @return: new array, missing values before the first valid one are left as NaN by 'ffill' and 'linear'
+    '''
+    data = as_station_data(data)
+    values = data.column(pollutant)
+    missing = np.isnan(values)
+    if not missing.any():
+        return values
+
+    if strategy == 'constant':
+        return np.where(missing, float(value), values)
+    if strategy == 'ffill':
+        last_valid = np.where(missing, 0, np.arange(len(values)))
+        np.maximum.accumulate(last_valid, out=last_valid)
+        return values[last_valid]
+    if strategy == 'linear':
+        valid = np.flatnonzero(~missing)
+        time = data.dates.astype(np.int64)
+        out = values.copy()
+        if len(valid):
+            inside = missing & (time > time[valid[0]]) & (time < time[valid[-1]])
+            out[inside] = np.interp(time[inside], time[valid], values[valid])
+        return out
+    if strategy == 'hourly_mean':
+        hourly = aggregate(data, pollutant, 'hour', ('mean',))
+        means = np.full(24, np.nan)
+        means[hourly['bucket']] = hourly['mean']
+        out = values.copy()
+        out[missing] = means[data.dates[missing].astype(np.int64) % 24]
+        return out
+    raise ValueError(f'Unknown fill strategy {strategy!r}, choose from {FILL_STRATEGIES}')
 
-    count = 0
-    ind = indices[pollutant]
-    for line in data:
-        if line[ind] == 'No data':
-            count += 1
-        else:
-            pass
 
-    return count
+def fill_missing(data, pollutant, strategy='constant', value=None):
+    '''
+    Returns a new StationData with the missing values of one column filled (see fill_column).
+    The other columns are shared with the input rather than copied, and the input is left untouched.
+    '''
+    data = as_station_data(data)
+    return data.with_column(pollutant, fill_column(data, pollutant, strategy, value))
 
 
 def fill_missing_data(data, new_value,  monitoring_station, pollutant):
     '''
-    Replaces all instances of missing values by a user-given value. 
+    Replaces all instances of missing values of the chosen pollutant by a user-given value. 
+    The value can also be the name of a fill strategy: 'ffill', 'linear' or 'hourly_mean' (see fill_column).
+
+    A StationData input returns a new StationData where only the pollutant's column is filled,
+    a list of csv lines is returned with the replacement applied to the pollutant's field.
     '''
+    strategy = new_value if new_value in FILL_STRATEGIES else 'constant'
+    if isinstance(data, StationData):
+        return fill_missing(data, pollutant, strategy, new_value)
+    if strategy != 'constant':
+        return fill_missing(data, pollutant, strategy)
+
+    ind = indices[pollutant]
     for L in range(1, len(data)):
-        data[L] = data[L].replace('No data', new_value)
+        if MISSING in data[L]:
+            fields = data[L].split(',')
+            if fields[ind] == MISSING:
+                fields[ind] = new_value
+                data[L] = ','.join(fields)
 
     return data
+
+
+REPORTS = {  # Named reports of the batch mode, as (bucketing rule, statistics) for aggregate()
+    'daily_average': ('day', ('mean',)),
+    'daily_median': ('day', ('median',)),
+    'hourly_average': ('hour', ('mean',)),
+    'monthly_average': ('month', ('mean',)),
+}
+
+
+def parse_report(report):
+    '''
+    Reads the name of a report: one of REPORTS, 'count_missing_data', or a bucketing rule followed by 
+    statistics and percentiles, eg: 'week:mean,max,p95'.
+
+    @return: (by, statistics, percentiles) for aggregate(), or None for 'count_missing_data'
+    '''
+    if report == 'count_missing_data':
+        return None
+    if report in REPORTS:
+        by, statistics = REPORTS[report]
+        return by, statistics, ()
+    by, _, names = report.partition(':')
+    if by not in ('hour', 'day', 'week', 'month', 'year'):
+        raise ValueError(f'Unknown report {report!r}')
+    statistics, percentiles = [], []
+    for name in names.split(',') if names else ['mean']:
+        if name in STATISTICS:
+            statistics.append(name)
+        elif name[:1] == 'p' and name[1:].replace('.', '', 1).isdigit():
+            percentiles.append(float(name[1:]))
+        else:
+            raise ValueError(f'Unknown statistic {name!r} in report {report!r}')
+    return by, tuple(statistics), tuple(percentiles)
+
+
+def run_report(data, pollutant, report):
+    '''
+    Computes one report (see parse_report) of a pollutant.
+
+    @param: data --> StationData (or csv lines)
+    @param: pollutant --> column to report on
+    @param: report --> name of the report
+
+    @return: dictionary of NumPy arrays as returned by aggregate(), or {'missing': number} for 'count_missing_data'
+    '''
+    data = as_station_data(data)
+    spec = parse_report(report)
+    if spec is None:
+        return {'missing': np.array([missing_counts(data)[pollutant]])}
+    return aggregate(data, pollutant, *spec)
+
+
+def _station_reports(path, jobs, fill):
+    '''
+    Worker of run_report_jobs: loads one station through its memory mapped cache and runs its jobs.
+    '''
+    data = load_station(path)
+    results = []
+    for pollutant, report in jobs:
+        filled = data if fill is None else fill_missing_data(data, fill, None, pollutant)
+        results.append(run_report(filled, pollutant, report))
+    return results
+
+
+def run_report_jobs(jobs, workers=None, fill=None):
+    '''
+    Runs (station file, pollutant, report) jobs (see run_report) over a pool of worker processes.
+
+    Jobs are sharded by station: each worker task loads its station once with load_station, so the 
+    columns are memory mapped from the binary cache rather than parsed or pickled, and only the 
+    (small) results travel back. The results are the same as running the jobs one by one.
+
+    @param: jobs --> iterable of (path to a station csv file, pollutant, report)
+    @param: workers --> number of worker processes (os.cpu_count() by default), 1 runs the jobs in this process
+    @param: fill --> optional value or strategy filling the missing data of each pollutant first (see fill_missing_data)
+
+    @return: list with the result of each job, in the order of the jobs
+    '''
+    jobs = list(jobs)
+    stations = {}
+    for i, (path, pollutant, report) in enumerate(jobs):
+        parse_report(report)  # Fails before any worker is started
+        stations.setdefault(path, []).append((i, pollutant, report))
+
+    tasks = [(path, [(pollutant, report) for _, pollutant, report in shard], fill) for path, shard in stations.items()]
+    if workers == 1 or len(tasks) <= 1:
+        outputs = [_station_reports(*task) for task in tasks]
+    else:
+        outputs = []
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(tasks))) as pool:
+            for output, counters in pool.map(functools.partial(worker_call, _station_reports), *zip(*tasks)):
+                merge_counters(counters)
+                outputs.append(output)
+
+    results = [None] * len(jobs)
+    for shard, output in zip(stations.values(), outputs):
+        for (i, _, _), result in zip(shard, output):
+            results[i] = result
+    return results
+
+
+class ReportCache:
+    '''
+    Least recently used cache of reporting results.
+
+    Results are keyed on the station, pollutant, reporting function, its extra arguments and the version
+    of the StationData they were computed from. Filling missing values creates a new version, so stale 
+    results are never returned and simply age out of the cache.
+
+    @param: maxsize --> maximum number of results kept
+    '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def run(self, function, data, *args):
+        '''
+        Returns function(data, *args), computing it only if it is not cached yet.
+        Raw csv lines are not versioned, so reports on them are computed without being cached.
+
+        @param: function --> reporting function, eg: daily_average
+        @param: data --> StationData the report is computed from
+        @param: args --> remaining arguments of the function, ending with (monitoring_station, pollutant)
+
+        @return: a copy of the cached result
+        '''
+        if not isinstance(data, StationData):
+            return function(data, *args)
+
+        monitoring_station, pollutant = args[-2:]
+        key = (data.monitoring_station or monitoring_station, pollutant, function.__name__, args[:-2], data.version)
+        if key in self._results:
+            self.hits += 1
+            self._results.move_to_end(key)
+        else:
+            self.misses += 1
+            self._results[key] = function(data, *args)
+            if len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+                self.evictions += 1
+        return copy.copy(self._results[key])
+
+    def clear(self):
+        self._results.clear()
+
+    def stats(self):
+        '''
+        Returns the hit, miss and eviction counters along with the hit rate and current size.
+        '''
+        calls = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / calls if calls else 0.0,
+                'size': len(self._results),
+                'maxsize': self.maxsize}
+
+
+report_cache = ReportCache()  # Cache shared by the reporting menu
+
+
+instrument_module(__name__)
@@ -1,7 +1,17 @@
+import json
+import os
+import threading
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 
+import benchmark
+import main
 from reporting import *
 from intelligence import *
+from monitoring import *
+from utils import *
 
 with open(f'./data/Pollution-London Marylebone Road.csv') as f:
     data = f.read().split('\n')
@@ -10,3 +20,580 @@ with open(f'./data/Pollution-London Marylebone Road.csv') as f:
 def test_daily_average_values():
     assert list(map(int, daily_average(data, 'MY1', 'no')[:9])) == [
         21, 11, 6, 3, 6]
+
+
+def test_station_data_adapter():
+    station = StationData.from_csv(
+        './data/Pollution-London Marylebone Road.csv', 'MY1')
+    assert len(station) == 8760
+    assert station.no.dtype == np.float64
+    assert str(station.dates[0]) == '2021-01-01T00'
+    assert count_missing_data(station, 'MY1', 'no') == count_missing_data(
+        data, 'MY1', 'no') > 0
+    assert daily_average(station, 'MY1', 'no') == daily_average(
+        data, 'MY1', 'no')
+
+
+def test_aggregate_matches_nan_reductions():
+    station = StationData.from_lines(data)
+    view = day_hour_view(station.no)
+    assert np.shares_memory(view, station.no)
+    daily = aggregate(station, 'no', 'day', percentiles=(95,))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN days
+        assert np.allclose(daily['median'], np.nanmedian(view, axis=1), equal_nan=True)
+        assert np.allclose(daily['p95'], np.nanpercentile(view, 95, axis=1), equal_nan=True)
+    assert list(daily['count']) == list((~np.isnan(view)).sum(axis=1))
+    monthly = aggregate(station, 'no', 'month', ('mean',))
+    assert monthly['count'].sum() == (~np.isnan(station.no)).sum()
+    assert np.isclose(monthly['mean'][0], np.nanmean(station.no[:31*24]))
+    # Without missing values the quantiles are read straight from the sorted columns
+    filled = fill_missing(station, 'no', 'linear')
+    complete = aggregate(filled, 'no', 'hour', ('median', 'min', 'max'), percentiles=(12.5, 90))
+    hours = day_hour_view(filled.no)
+    assert np.allclose(complete['median'], np.median(hours, axis=0))
+    assert np.allclose(complete['p12.5'], np.percentile(hours, 12.5, axis=0))
+    assert np.array_equal(complete['max'], hours.max(axis=0)) and (complete['count'] == 365).all()
+    empty = aggregate(station[:0], 'no', 'hour')
+    assert list(empty['bucket']) == list(range(24)) and len(empty['mean']) == 24
+
+
+def test_calendar_buckets_with_leap_year_and_gaps():
+    dates = np.arange('2020-02-27T10', '2020-03-02T00', dtype='datetime64[h]')
+    dates = np.delete(dates, np.s_[20:30])  # 10 hour gap on 28 February
+    values = np.arange(len(dates), dtype=float)
+    station = StationData(dates, values, values, values)
+    assert not station.is_regular()
+
+    daily = aggregate(station, 'no', 'day', ('mean',))
+    assert [str(d) for d in daily['bucket']] == [
+        '2020-02-27', '2020-02-28', '2020-02-29', '2020-03-01']
+    assert list(daily['count']) == [14, 14, 24, 24]
+    monthly = aggregate(station, 'no', 'month', ('mean',))
+    assert list(monthly['count']) == [52, 24]
+    weekly = aggregate(station, 'no', 'week', ('mean',))
+    assert str(weekly['bucket'][0]) == '2020-02-24'
+    assert peak_hour_date(station, '2020-02-29', 'MY1', 'no') == '24:00, 51.0'
+
+
+def test_date_index_queries():
+    station = StationData.from_lines(data)
+    assert station.index.day('2021-03-04') == slice(62*24, 63*24)
+    day = station.pm10[62*24:63*24]
+    hour, value = peak_hour_date(station, '2021-03-04', 'MY1', 'pm10').split(', ')
+    assert float(value) == np.nanmax(day)
+    assert hour == f'{np.nanargmax(day) + 1}:00'
+
+    week = top_hours(station, '2021-01-04', '2021-01-11', 3, 'MY1', 'no')
+    assert [v for _, v in week] == sorted(
+        np.sort(station.no[3*24:10*24][~np.isnan(station.no[3*24:10*24])])[-3:], reverse=True)
+    assert peak_hour_range(station, '2021-01-04', '2021-01-11', 'MY1', 'no') == week[0]
+    assert top_hours(station, '2021-01-04', '2021-01-11', 0, 'MY1', 'no') == []
+    assert value_at(station, '2021-01-01T00', 'MY1', 'no') == station.no[0]
+    assert value_at(station, '2022-01-01T00', 'MY1', 'no') is None
+
+
+def test_streaming_aggregators_match_whole_file():
+    path = './data/Pollution-London Marylebone Road.csv'
+    station = StationData.from_lines(data)
+    whole = aggregate(station, 'pm25', 'day', percentiles=(90,))
+    streamed = stream_aggregate(read_station_chunks(path, chunk_size=1000), 'pm25', 'day', percentiles=(90,))
+    for key in whole:
+        assert np.array_equal(whole[key], streamed[key], equal_nan=True)
+    assert stream_daily_average(path, 'MY1', 'no') == daily_average(station, 'MY1', 'no')
+    assert np.allclose(stream_hourly_average(path, 'MY1', 'pm10'), hourly_average(station, 'MY1', 'pm10'))
+    assert np.allclose(stream_monthly_average(path, 'MY1', 'pm10'),
+                       monthly_average(station, 'MY1', 'pm10'), equal_nan=True)
+
+
+def test_station_cache_is_rebuilt_when_the_file_changes(tmp_path):
+    path = str(tmp_path / 'station.csv')
+    with open(path, 'w') as f:
+        f.write('\n'.join(data[:49]))
+    cold = load_station(path)
+    warm = load_station(path)
+    assert os.path.exists(os.path.join(cache_directory(path), 'meta.json'))
+    assert not warm.no.flags.writeable  # memory mapped from the cache
+    assert np.array_equal(cold.no, warm.no, equal_nan=True)
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(data[:25]))
+    changed = load_station(path)
+    assert len(changed) == 24
+    assert len(load_station(path)) == 24
+    # The rebuild must not truncate the files still mapped by the previous load (SIGBUS when read)
+    assert len(warm) == 48 and np.array_equal(warm.no, cold.no, equal_nan=True)
+
+
+def test_report_cache_hits_and_invalidation():
+    cache = ReportCache(maxsize=2)
+    station = StationData.from_lines(data, 'MY1')
+    first = cache.run(daily_median, station, 'MY1', 'no')
+    assert cache.run(daily_median, station, 'MY1', 'no') == first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    filled = fill_missing_data(station, '0', 'MY1', 'no')
+    assert cache.run(daily_median, filled, 'MY1', 'no') != first
+    cache.run(daily_median, filled, 'MY1', 'pm10')
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['size'] == 2
+
+
+def test_missing_data_strategies_are_column_scoped():
+    station = StationData.from_lines(data, 'MY1')
+    counts = missing_counts(station)
+    assert counts['no'] == count_missing_data(data, 'MY1', 'no')
+    starts, lengths = missing_runs(station, 'no')
+    assert lengths.sum() == counts['no']
+    assert np.isnan(value_at(station, starts[0], 'MY1', 'no'))
+
+    for strategy in ('ffill', 'hourly_mean'):
+        filled = fill_missing(station, 'no', strategy)
+        assert np.isnan(filled.no).sum() == 0
+        assert np.shares_memory(filled.pm10, station.pm10)
+    assert missing_counts(station) == counts
+
+    dates = np.array(['2021-01-01T00', '2021-01-01T01', '2021-01-01T05', '2021-01-01T06'], dtype='datetime64[h]')
+    values = np.array([1, np.nan, np.nan, 4.])
+    gappy = StationData(dates, values, values, values)
+    assert list(fill_column(gappy, 'no', 'linear')) == [1, 1.5, 3.5, 4]
+    assert list(missing_runs(gappy, 'no')[1]) == [5]
+
+    lines = fill_missing_data(list(data), '0', 'MY1', 'no')
+    assert count_missing_data(lines, 'MY1', 'no') == 0
+    assert count_missing_data(lines, 'MY1', 'pm25') == counts['pm25']
+
+
+def test_colour_masks_match_pixel_thresholds():
+    image = read_image('./data/map.png')
+    masks = colour_masks(image)
+    rgb = image[..., :3].astype(int)
+    red = (rgb[..., 0] > 100) & (rgb[..., 1] < 50) & (rgb[..., 2] < 50)
+    cyan = (rgb[..., 0] < 50) & (rgb[..., 1] > 100) & (rgb[..., 2] > 100)
+    assert np.array_equal(masks['red'], red)
+    assert np.array_equal(masks['cyan'], cyan)
+    assert np.array_equal(unpack_mask(pack_mask(red), red.shape), red)
+    white = colour_mask(image, ((200, 255), (200, 255), (200, 255)))
+    assert white.sum() == ((rgb >= 200).all(axis=-1)).sum()
+
+
+def flood_fill_labels(mask, connectivity):
+    # Reference breadth-first labelling, in raster scan order
+    steps = [(-1, 0), (0, -1), (0, 1), (1, 0)]
+    if connectivity == 8:
+        steps += [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+    labels = np.zeros(mask.shape, dtype=int)
+    region = 0
+    for row, col in zip(*np.nonzero(mask)):
+        if labels[row, col]:
+            continue
+        region += 1
+        labels[row, col] = region
+        queue = [(row, col)]
+        while queue:
+            m, n = queue.pop()
+            for dm, dn in steps:
+                s, t = m + dm, n + dn
+                if 0 <= s < mask.shape[0] and 0 <= t < mask.shape[1] and mask[s, t] and not labels[s, t]:
+                    labels[s, t] = region
+                    queue.append((s, t))
+    return labels
+
+
+def test_label_components_matches_flood_fill():
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        mask = rng.random((25, 31)) < 0.45
+        for connectivity in (4, 8):
+            labels, sizes = label_components(mask, connectivity)
+            expected = flood_fill_labels(mask, connectivity)
+            assert np.array_equal(labels, expected)
+            assert list(sizes[1:]) == list(np.bincount(expected.ravel())[1:])
+
+    corners = np.zeros((5, 5), dtype=bool)
+    corners[0, 0] = corners[-1, -1] = True  # must not wrap around the edges
+    labels, sizes = label_components(corners)
+    assert list(sizes) == [0, 1, 1]
+
+
+def test_component_stats_and_top_components():
+    mask = np.zeros((6, 8), dtype=bool)
+    mask[0:2, 0:3] = True   # 6 pixels
+    mask[4, 1:7] = True     # 6 pixels
+    mask[3:6, 7] = True     # 3 pixels, touches the row above diagonally
+    mask[0, 6] = True       # 1 pixel
+    labels, sizes = label_components(mask)
+    stats = component_stats(labels)
+    assert list(stats['size']) == list(sizes) == [0, 6, 1, 9]
+    assert list(stats['bbox'][3]) == [3, 1, 5, 7]
+    assert list(stats['centroid'][1]) == [0.5, 1.0]
+    assert list(top_components(sizes, 2)) == [3, 1]
+    assert list(top_components(sizes, 10)) == [3, 1, 2]
+    image = render_components(labels, [2])
+    assert image.shape == (6, 8, 3) and image[..., 0].sum() == 1
+
+
+def test_tiled_labelling_matches_whole_image(tmp_path):
+    path = str(tmp_path / 'map.npy')
+    export_raster('./data/map.png', path)
+    raster = open_raster(path)
+    mask = colour_mask(read_image('./data/map.png'), 'red')
+    assert np.array_equal(tiled_colour_mask(raster, 'red', tile=300), mask)
+    for connectivity in (4, 8):
+        expected = label_components(mask, connectivity)
+        labels, sizes = tiled_label_components(raster, 'red', tile=(128, 200), connectivity=connectivity)
+        assert np.array_equal(labels, expected[0])
+        assert np.array_equal(sizes, expected[1])
+
+    rng = np.random.default_rng(1)
+    mask = rng.random((40, 50)) < 0.5
+    labels, sizes = tiled_label_components(mask, tile=7)
+    assert np.array_equal(labels, label_components(mask)[0])
+
+
+def test_parallel_tiles_match_serial_labelling():
+    image = read_image('./data/map.png')
+    mask = colour_mask(image, 'red')
+    labels, sizes = parallel_label_components(image, 'red', tile=(300, 400), workers=2)
+    expected = label_components(mask)
+    assert np.array_equal(labels, expected[0])
+    assert np.array_equal(sizes, expected[1])
+    assert np.array_equal(parallel_colour_mask(image, 'red', tile=500, workers=2), mask)
+
+
+def test_map_pipeline_keeps_masks_in_memory(tmp_path, monkeypatch):
+    image = read_image('./data/map.png')
+    monkeypatch.chdir(tmp_path)
+    assert np.array_equal(binary_mask(find_red_pixels(image, output=None)), colour_mask(image, 'red'))
+    assert list(tmp_path.iterdir()) == []
+
+    result = map_pipeline(image, mask_file=str(tmp_path / 'mask.npz'))
+    assert np.array_equal(result['labels'], label_components(result['mask'])[0])
+    assert result['sizes'][result['order'][0]] == result['sizes'].max()
+    assert np.array_equal(load_mask(str(tmp_path / 'mask.npz')), result['mask'])
+    assert list(tmp_path.iterdir()) == [tmp_path / 'mask.npz']
+
+    labels, sizes = detect_connected_components(result['mask'], report=None)
+    assert np.array_equal(labels, result['labels'])
+
+
+def canned_payload(site, species, values, start='2023-01-02 00:00:00'):
+    first = datetime.datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
+    return {'RawAQData': {'@SiteCode': site, '@SpeciesCode': species, 'Data': [
+        {'@MeasurementDateGMT': str(first + datetime.timedelta(hours=i)), '@Value': value}
+        for i, value in enumerate(values)]}}
+
+
+@pytest.fixture
+def stub_api():
+    # Local LondonAir stand-in serving canned RawAQData, failing the first request of every FLAKY site
+    state = {'requests': [], 'failed': set(), 'values': {}}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            fields = dict(part.split('=') for part in self.path.split('/') if '=' in part)
+            state['requests'].append(fields)
+            site, species = fields['SiteCode'], fields['SpeciesCode']
+            if site.startswith('FLAKY') and site not in state['failed']:
+                state['failed'].add(site)
+                self.send_response(503)
+                self.end_headers()
+                return
+            values = state['values'].get((site, species), ['1.5', '', '3'])
+            body = json.dumps(canned_payload(site, species, values, fields['StartDate'] + ' 00:00:00')).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state['url'] = f'http://127.0.0.1:{server.server_port}'
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def test_client_fetches_jobs_concurrently_with_retries(stub_api):
+    jobs = [(site, species, datetime.date(2023, 1, 2))
+            for site in ('MY1', 'FLAKY1') for species in ('NO', 'PM10', 'PM25')]
+    with LondonAirClient(stub_api['url'], max_concurrency=3, timeout=5, backoff=0.01) as client:
+        payloads = client.fetch_many(jobs)
+    assert [(p['RawAQData']['@SiteCode'], p['RawAQData']['@SpeciesCode']) for p in payloads] == [
+        job[:2] for job in jobs]
+    assert treat_data(payloads[0])[:2] == [['2023-01-02 00:00:00', 1.5], ['2023-01-02 01:00:00', 'N/A']]
+    assert len(stub_api['requests']) == len(jobs) + 1
+
+    with LondonAirClient('http://127.0.0.1:9', retries=1, backoff=0.01, timeout=1) as client:
+        failed = client.fetch_many([('MY1', 'NO')], return_exceptions=True)
+    assert isinstance(failed[0], requests.ConnectionError)
+
+
+def test_response_cache_fetches_only_missing_or_stale_days(stub_api, tmp_path):
+    stub_api['values'][('MY1', 'NO')] = [str(i) for i in range(48)]
+    client = LondonAirClient(stub_api['url'], backoff=0.01)
+    cache = ResponseCache(str(tmp_path), ttl=60, client=client)
+    first = cache.fetch('MY1', 'NO', datetime.date(2023, 1, 2), datetime.date(2023, 1, 4))
+    assert [row[1] for row in first] == list(map(float, range(48)))
+    assert len(stub_api['requests']) == 1
+
+    week = cache.fetch('MY1', 'NO', datetime.date(2023, 1, 1), datetime.date(2023, 1, 5))
+    assert len(week) == 96 and week[24:72] == first
+    assert sorted((r['StartDate'], r['EndDate']) for r in stub_api['requests'][1:]) == [
+        ('2023-01-01', '2023-01-02'), ('2023-01-04', '2023-01-05')]
+
+    today = datetime.date.today()
+    cache.fetch('MY1', 'NO', today)
+    cache.fetch('MY1', 'NO', today)
+    assert len(stub_api['requests']) == 4
+    cache.ttl = -1
+    cache.fetch('MY1', 'NO', today)
+    assert len(stub_api['requests']) == 5
+    client.close()
+
+
+def test_response_cache_refetches_days_cached_before_their_end(stub_api, tmp_path, monkeypatch):
+    import monitoring
+    monday = datetime.date(2023, 1, 2)
+    clock = {'now': datetime.datetime(2023, 1, 2, 10, tzinfo=datetime.timezone.utc).timestamp()}
+    monkeypatch.setattr(monitoring.time, 'time', lambda: clock['now'])
+    client = LondonAirClient(stub_api['url'], backoff=0.01)
+    cache = ResponseCache(str(tmp_path), ttl=60, client=client)
+    stub_api['values'][('MY1', 'NO')] = ['1'] * 10
+    assert len(cache.fetch('MY1', 'NO', monday, monday + datetime.timedelta(days=1))) == 10
+
+    # The next day, Monday's partial entry is stale and fetched again in full
+    clock['now'] += 24 * 3600
+    stub_api['values'][('MY1', 'NO')] = ['1'] * 24
+    assert len(cache.fetch('MY1', 'NO', monday, monday + datetime.timedelta(days=1))) == 24
+    assert len(stub_api['requests']) == 2
+
+    # Fetched after its end, the day is now kept for good
+    clock['now'] += 30 * 24 * 3600
+    assert len(cache.fetch('MY1', 'NO', monday, monday + datetime.timedelta(days=1))) == 24
+    assert len(stub_api['requests']) == 2
+    client.close()
+
+
+def test_incremental_ingester_appends_only_new_hours(stub_api):
+    day = datetime.date(2023, 1, 2)
+    stub_api['values'][('MY1', 'NO')] = ['1', '2', '']
+    with LondonAirClient(stub_api['url'], backoff=0.01) as client:
+        ingester = IncrementalIngester(client, start_date=day, max_size=4)
+        assert ingester.poll('MY1', 'NO') == 2  # the unpublished last hour is left for later
+        stub_api['values'][('MY1', 'NO')] = ['1', '2', '3', '', '5', '6']
+        assert ingester.poll_many([('MY1', 'NO')]) == [4]
+        assert ingester.poll('MY1', 'NO') == 0
+    assert stub_api['requests'][-1]['StartDate'] == '2023-01-02'
+
+    buffer = ingester.buffers[('MY1', 'NO')]
+    times, values = buffer.window()
+    assert len(buffer) == 4 and str(times[0]) == '2023-01-02T02'
+    assert np.isnan(values[1]) and list(values[[0, 2, 3]]) == [3, 5, 6]
+    assert (buffer.count, buffer.total, buffer.minimum, buffer.maximum) == (5, 17, 1, 6)
+
+    # A gap within the last day may still be filled, so nothing after it is consumed yet
+    today = datetime.date.today()
+    stub_api['values'][('MY1', 'NO')] = ['1', '', '3']
+    with LondonAirClient(stub_api['url'], backoff=0.01) as client:
+        ingester = IncrementalIngester(client, start_date=today)
+        assert ingester.poll('MY1', 'NO') == 1
+        stub_api['values'][('MY1', 'NO')] = ['1', '2', '3']
+        assert ingester.poll('MY1', 'NO') == 2
+    assert list(ingester.buffers[('MY1', 'NO')].window()[1]) == [1, 2, 3]
+
+
+def test_risk_detectors_flag_iqr_outliers():
+    rng = np.random.default_rng(3)
+    values = list(rng.normal(20, 2, 300)) + [60.0]
+    data = [[f'2023-01-01 {i}', float(v)] for i, v in enumerate(values)] + [['2023-01-14 13:00:00', 'N/A']]
+    outliers = check_risk_in_area(data)
+    q1, q3 = np.percentile(values, [25, 75])
+    assert outliers == [(v, d) for d, v in sorted(data[:-1], key=lambda line: line[1]) if v > q3 + 1.5 * (q3 - q1)]
+    assert outliers[-1] == (60.0, '2023-01-01 300')
+
+    monitor = RiskMonitor({('MY1', 'NO'): {'window': 24}}, window=100, min_samples=10)
+    flagged = monitor.update_many('MY1', 'NO', range(len(values)), values)
+    assert flagged[-1] == (300, 60.0)
+    detector = monitor.detector('MY1', 'NO')
+    assert len(detector) == 24 and detector.window == 24
+    window = np.array(values[-24:])
+    q1, q3 = np.percentile(window, [25, 75])
+    assert np.isclose(detector.threshold(), q3 + 1.5 * (q3 - q1))
+    assert monitor.detector('KC1', 'NO').window == 100
+
+    # Heap-based quartiles agree with the sorted window, including ties and windows of every small size
+    for window in (1, 2, 3, 7, 24):
+        detector = RiskDetector(window=window, min_samples=1)
+        stream = np.r_[rng.integers(0, 4, 150), rng.normal(0, 3, 150)]
+        for i, value in enumerate(stream):
+            if i:
+                ordered = sorted(stream[max(0, i - window):i])
+                q1, q3 = quantile(ordered, 0.25), quantile(ordered, 0.75)
+                assert np.isclose(detector.threshold(), q3 + 1.5 * (q3 - q1))
+            detector.update(i, float(value))
+
+
+def test_decode_payload_matches_treat_data():
+    raw = canned_payload('MY1', 'NO', ['4.5', '', '6', '200', '5', '5.5', '4'])
+    samples = decode_payload(raw)
+    assert samples.dtype == SAMPLE_DTYPE
+    assert samples['time'][1] == np.datetime64('2023-01-02T01')
+    assert np.array_equal(samples['value'], [4.5, np.nan, 6, 200, 5, 5.5, 4], equal_nan=True)
+    treated = as_samples(treat_data(raw))
+    assert (treated['time'] == samples['time']).all()
+    assert np.array_equal(treated['value'], samples['value'], equal_nan=True)
+    assert check_risk_in_area(samples) == check_risk_in_area(treat_data(raw)) == [(200.0, '2023-01-02 03:00:00')]
+    assert average_pol(samples, datetime.date(2023, 1, 2)) == 'Success'
+
+
+def test_live_snapshot_aligns_sites_and_species(stub_api, tmp_path):
+    stub_api['values'][('MY1', 'NO')] = ['4', '5', '', '6', '5', '4', '90']
+    stub_api['values'][('KC1', 'PM10')] = ['', '', '7']
+    stub_api['values'][('KC1', 'NO')] = []
+    client = LondonAirClient(stub_api['url'], backoff=0.01)
+    cache = ResponseCache(str(tmp_path), client=client)
+    snap = live_snapshot(['MY1', 'KC1'], ['NO', 'PM10'], datetime.date(2023, 1, 2), datetime.date(2023, 1, 3), cache)
+    client.close()
+    assert len(stub_api['requests']) == 4
+    assert snap['values'].shape == (2, 2, 24) and snap['hours'][0] == np.datetime64('2023-01-02T00')
+    assert np.array_equal(snap['values'][1, 1, :4], [np.nan, np.nan, 7, np.nan], equal_nan=True)
+    assert snap['count'].tolist() == [[6, 2], [0, 1]]
+    assert snap['latest'][0].tolist() == [90, 3] and snap['latest'][1, 1] == 7 and np.isnan(snap['latest'][1, 0])
+    assert snap['max'][0, 0] == 90 and snap['mean'][0, 1] == 2.25
+    assert snap['risk'][0, 0].nonzero()[0].tolist() == [6]
+    assert snap['at_risk'].tolist() == [[True, False], [False, False]]
+
+
+def test_running_stats_single_pass_and_mergeable():
+    values = np.array([1e8 + 0.1, 3.5, np.nan, 2, 2, -7.25] * 50)
+    whole = RunningStats(values)
+    assert whole.count == 250 and whole.missing == 50
+    assert whole.total == pytest.approx(np.nansum(values)) and whole.mean == pytest.approx(np.nanmean(values))
+    assert whole.variance(1) == pytest.approx(np.nanvar(values, ddof=1))
+    assert (whole.minimum, whole.maximum, whole.counts[2.0]) == (-7.25, 1e8 + 0.1, 100)
+
+    merged = RunningStats(values[:7].tolist()).merge(RunningStats(values[7:100])).update(iter(values[100:]))
+    assert (merged.count, merged.minimum, merged.maximum, merged.counts) == (
+        whole.count, whole.minimum, whole.maximum, whole.counts)
+    assert merged.total == pytest.approx(whole.total) and merged.std() == pytest.approx(whole.std())
+
+    assert sumvalues([1, 2, 3]) == 6 and meannvalue([1, 2]) == 1.5 and countvalue(values, 2) == 100
+    for function in (maxvalue, minvalue, meannvalue):
+        with pytest.raises(ValueError):
+            function([])
+    with pytest.raises(ValueError):
+        sumvalues([1, 'a'])
+    stats = RunningStats([1., 2.])
+    with pytest.raises(ValueError):
+        stats.add('x')
+    stats.add(3.)
+    assert (stats.count, stats.mean, stats.total, stats.maximum) == (3, 2.0, 6.0, 3.)
+
+
+def test_benchmark_synthetic_station_and_baseline(tmp_path):
+    path = benchmark.generate_station_csv(str(tmp_path / 'station.csv'), years=2, missing_rate=0.1, seed=3)
+    with open(path) as f:
+        lines = f.read().split('\n')
+    assert lines[0] == 'date,time,no,pm10,pm25' and len(lines) == 1 + 2*8760
+    assert lines[1].startswith('2021-01-01,01:00:00,') and lines[24].startswith('2021-01-01,24:00:00,')
+    station = load_station(path)
+    assert len(station) == 2*8760 and 0.08 < missing_counts(station)['pm10'] / len(station) < 0.12
+    with open(benchmark.generate_station_csv(str(tmp_path / 'again.csv'), 2, 0.1, 3)) as f:
+        assert f.read().split('\n') == lines
+
+    baseline = {'config': {'years': 1}, 'results': {'a': {'wall': 0.1, 'peak_rss': 100}, 'b': {'wall': 0.001, 'peak_rss': 100}}}
+    report = {'config': {'years': 1}, 'results': {'a': {'wall': 0.2, 'peak_rss': 100}, 'b': {'wall': 0.002, 'peak_rss': 200}}}
+    assert len(benchmark.compare(report, baseline)) == 2
+    assert benchmark.compare(baseline, baseline) == []
+    with pytest.raises(ValueError):
+        benchmark.compare(report, dict(baseline, config={'years': 2}))
+
+
+def test_instrumentation_records_calls_as_json_lines(tmp_path):
+    import instrumentation
+    assert not instrumentation.is_enabled()
+    path = str(tmp_path / 'trace.jsonl')
+    instrumentation.enable(path)
+    try:
+        daily_median(StationData.from_csv('./data/Pollution-London Marylebone Road.csv'), 'MY1', 'no')
+        totals = instrumentation.summary()
+    finally:
+        instrumentation.disable()
+    assert totals['reporting.read_station_chunks']['bytes_read'] == os.path.getsize('./data/Pollution-London Marylebone Road.csv')
+    assert totals['reporting.StationData.from_csv']['rows'] == totals['reporting.aggregate']['rows'] == 8760
+    assert totals['reporting.daily_median']['calls'] == 1 and totals['reporting.daily_median']['wall'] > 0
+
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    calls = [entry for entry in entries if 'function' in entry]
+    assert calls[-1]['function'] == 'reporting.daily_median' and calls[-1]['depth'] == 0
+    assert {entry['summary'] for entry in entries if 'summary' in entry} == set(totals)
+    daily_median(data, 'MY1', 'no')
+    assert instrumentation.summary() == totals
+
+
+def test_batch_mode_writes_every_job(tmp_path):
+    spec = {'stations': ['MY1', 'KC1'], 'pollutants': ['no', 'pm25'], 'output': str(tmp_path),
+            'reports': ['monthly_average', 'day:max,p90', 'count_missing_data'], 'format': 'json', 'workers': 2}
+    paths = main.run_batch(spec)
+    assert [os.path.basename(path) for path in paths[:3]] == [
+        'MY1-no-monthly_average.json', 'MY1-no-day_max-p90.json', 'MY1-no-count_missing_data.json']
+    assert len(paths) == len(set(paths)) == 12
+    with open(tmp_path / 'KC1-pm25-monthly_average.json') as f:
+        monthly = json.load(f)
+    assert monthly['bucket'][0] == '2021-01' and np.allclose(
+        monthly['mean'], monthly_average(load_station(main.STATION_FILES['KC1']), 'KC1', 'pm25'))
+    with open(tmp_path / 'MY1-pm25-count_missing_data.json') as f:
+        assert json.load(f) == {'missing': [count_missing_data(data, 'MY1', 'pm25')]}
+
+    main.run_batch(dict(spec, format='csv', reports=['hourly_average'], fill='0'))
+    with open(tmp_path / 'MY1-pm25-hourly_average.csv') as f:
+        lines = f.read().split('\n')
+    assert lines[0] == 'bucket,count,mean' and lines[1].startswith('0,365,')
+    with pytest.raises(ValueError):
+        main.run_batch(dict(spec, reports=['fortnight']))
+
+
+def test_report_jobs_in_processes_match_serial(tmp_path):
+    paths = [benchmark.generate_station_csv(str(tmp_path / f'{i}.csv'), missing_rate=0.05, seed=i) for i in range(3)]
+    jobs = [(path, pol, report) for pol in ('no', 'pm25') for path in paths
+            for report in ('daily_median', 'week:mean,p90', 'count_missing_data')]
+    serial = run_report_jobs(jobs, workers=1, fill='linear')
+    parallel = run_report_jobs(jobs, workers=3, fill='linear')
+    assert len(parallel) == len(jobs)
+    for (path, pol, report), one, other in zip(jobs, serial, parallel):
+        expected = run_report(fill_missing_data(load_station(path), 'linear', None, pol), pol, report)
+        assert one.keys() == other.keys() == expected.keys()
+        assert all(np.array_equal(one[key], other[key], equal_nan=True) for key in one)
+        assert all(np.array_equal(one[key], expected[key], equal_nan=True) for key in one)
+    assert serial[2]['missing'][0] == 0
+
+
+def test_instrumentation_collects_worker_calls(tmp_path):
+    import instrumentation
+    paths = [benchmark.generate_station_csv(str(tmp_path / f'{i}.csv'), seed=i) for i in range(2)]
+    jobs = [(path, 'no', report) for path in paths for report in ('daily_median', 'monthly_average')]
+    run_report_jobs(jobs, workers=1)  # Builds the station caches first
+    totals = {}
+    for workers in (1, 2):
+        path = str(tmp_path / f'trace-{workers}.jsonl')
+        instrumentation.enable(path)
+        try:
+            run_report_jobs(jobs, workers=workers)
+            parallel_colour_mask(read_image('./data/map.png'), tile=400, workers=workers)
+            totals[workers] = instrumentation.summary()
+        finally:
+            instrumentation.disable()
+    serial, parallel = totals[1], totals[2]
+    assert {name: counters['calls'] for name, counters in parallel.items()} == {
+        name: counters['calls'] for name, counters in serial.items()}
+    assert parallel['reporting.run_report']['calls'] == 4 and parallel['intelligence.colour_mask']['calls'] > 1
+    assert parallel['reporting.run_report_jobs']['rows'] == serial['reporting.run_report_jobs']['rows'] > 0
+    with open(path) as f:
+        summaries = {entry['summary'] for entry in map(json.loads, f) if 'summary' in entry}
+    assert summaries == set(parallel)
@@ -1,55 +1,177 @@
+import math
+
+import numpy as np
+
+from instrumentation import instrument_module
+
+
+class RunningStats:
+    '''
+    Single pass accumulator of count, sum, minimum, maximum, mean, variance and value counts.
+
+    The sum uses Kahan compensated summation and the mean/variance Welford's update, so long float
+    inputs do not drift. NumPy arrays are folded in one vectorised step, and two accumulators built
+    over different chunks (or in different workers) can be merged into the statistics of both.
+    Missing values (NaN) are skipped and counted in .missing.
+
+    @param: values --> optional iterable or NumPy array folded in straight away
+    @param: value_counts --> whether to keep a count of every distinct value (see .counts)
+    '''
+
+    def __init__(self, values=(), value_counts=True):
+        self.count = 0
+        self.missing = 0
+        self.total = 0
+        self._compensation = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # Sum of squared deviations from the mean
+        self.minimum = None
+        self.maximum = None
+        self.counts = {} if value_counts else None
+        self.update(values)
+
+    def __repr__(self):
+        return f'RunningStats(count={self.count}, mean={self.mean}, min={self.minimum}, max={self.maximum})'
+
+    def add(self, value):
+        '''
+        Folds a single value into the accumulator.
+        '''
+        try:
+            if value != value:
+                self.missing += 1
+                return self
+            # Everything is computed into locals first, so a non-numerical value leaves the state untouched
+            count = self.count + 1
+            # Kahan summation (the compensation stays 0 for integers, which are summed exactly)
+            adjusted = value - self._compensation
+            total = self.total + adjusted
+            compensation = (total - self.total) - adjusted
+            # Welford's update of the mean and of the squared deviations
+            delta = value - self.mean
+            mean = self.mean + delta / count
+            m2 = self._m2 + delta * (value - mean)
+            minimum = value if self.minimum is None or value < self.minimum else self.minimum
+            maximum = value if self.maximum is None or value > self.maximum else self.maximum
+        except TypeError as error:
+            raise ValueError("value error, check input for non-numerical values") from error
+        self.count, self.total, self._compensation = count, total, compensation
+        self.mean, self._m2 = mean, m2
+        self.minimum, self.maximum = minimum, maximum
+        if self.counts is not None:
+            self.counts[value] = self.counts.get(value, 0) + 1
+        return self
+
+    def update(self, values):
+        '''
+        Folds an iterable of values into the accumulator, in one vectorised step for NumPy arrays.
+
+        @return: the accumulator itself
+        '''
+        if isinstance(values, np.ndarray):
+            if values.dtype.kind not in 'biuf':
+                raise ValueError("value error, check input for non-numerical values")
+            return self.merge(self._from_array(values.ravel()))
+        for value in values:
+            self.add(value)
+        return self
+
+    def _from_array(self, values):
+        part = RunningStats(value_counts=self.counts is not None)
+        if values.dtype.kind == 'f':
+            valid = values[~np.isnan(values)]
+            part.missing = len(values) - len(valid)
+            values = valid
+        if len(values) == 0:
+            return part
+        # np.sum is pairwise, which keeps the rounding error low without a compensation term
+        part.count = len(values)
+        part.total = values.sum(dtype=np.float64 if values.dtype.kind == 'f' else None).item()
+        part.mean = part.total / part.count
+        part._m2 = float(np.square(values - part.mean).sum())
+        part.minimum = values.min().item()
+        part.maximum = values.max().item()
+        if part.counts is not None:
+            distinct, counts = np.unique(values, return_counts=True)
+            part.counts = dict(zip(distinct.tolist(), counts.tolist()))
+        return part
+
+    def merge(self, other):
+        '''
+        Folds the statistics of another accumulator into this one (Chan et al. parallel update).
+
+        @param: other --> RunningStats built over other values
+
+        @return: the accumulator itself
+        '''
+        self.missing += other.missing
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        adjusted = other.total - self._compensation - other._compensation
+        total = self.total + adjusted
+        self._compensation = (total - self.total) - adjusted
+        self.total = total
+        self.count = count
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        if self.counts is not None:
+            for value, n in (other.counts or {}).items():
+                self.counts[value] = self.counts.get(value, 0) + n
+        return self
+
+    def variance(self, ddof=0):
+        '''
+        Variance of the values (population variance by default, ddof=1 for the sample variance).
+        NaN when there are not more than ddof values.
+        '''
+        if self.count <= ddof:
+            return math.nan
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        '''
+        Standard deviation of the values, see variance.
+        '''
+        return math.sqrt(self.variance(ddof))
+
+
 def sumvalues(values):
-    total = 0
-    try:
-        for num in values:
-            total += num
-        return total
-    except:
-        raise ValueError(
-            "value error, check input for non-numerical values")
+    return RunningStats(values, value_counts=False).total
 
 
 def maxvalue(values):
-    current_max = values[0]
-    try:
-        for num in values:
-            if num > current_max:
-                current_max = num
-        return current_max
-    except:
-        raise ValueError(
-            "value error, check input for non-numerical values")
+    stats = RunningStats(values, value_counts=False)
+    if stats.count == 0:
+        raise ValueError("value error, cannot take the maximum of an empty input")
+    return stats.maximum
 
 
 def minvalue(values):
-    current_min = values[0]
-    try:
-        for num in values:
-            if num < current_min:
-                current_min = num
-        return current_min
-    except:
-        raise ValueError(
-            "value error, check input for non-numerical values")
+    stats = RunningStats(values, value_counts=False)
+    if stats.count == 0:
+        raise ValueError("value error, cannot take the minimum of an empty input")
+    return stats.minimum
 
 
 def meannvalue(values):
-    # if not is int or float: raise instance
-    total = 0
-    count = 0
-    for val in values:
-        try:
-            total += val
-        except:
-            raise ValueError(
-                "value error, check input for non-numerical values")
-        count += 1
-    return total / count
+    stats = RunningStats(values, value_counts=False)
+    if stats.count == 0:
+        raise ValueError("value error, cannot take the mean of an empty input")
+    return stats.mean
 
 
 def countvalue(values, x):
+    if isinstance(values, np.ndarray):
+        return int(np.count_nonzero(values == x))
     count = 0
     for val in values:
         if val == x:
             count += 1
     return count
+
+
+instrument_module(__name__, exclude=('RunningStats.add',))  # add() runs once per element of plain iterables